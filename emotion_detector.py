@@ -14,12 +14,71 @@ from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
 from collections import deque
 import queue
+import csv
+import shutil
+import tempfile
+import tracemalloc
+import argparse
+import base64
+import json
+import http.client
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
 
 # ค่าคงที่สำหรับการปรับแต่งประสิทธิภาพ
 FRAME_SKIP = 2  # ข้ามเฟรมทุก 2 เฟรม
 EMOTION_CACHE_SIZE = 5  # จำนวนเฟรมที่เก็บแคช
 EXCEL_SAVE_INTERVAL = 10  # บันทึก Excel ทุก 10 ครั้ง
+EXCEL_MIN_SAVE_SECONDS = 1.0  # เว้นระยะขั้นต่ำระหว่างการเขียน workbook ทั้งไฟล์
+EXCEL_MAX_SAVE_DUTY = 0.1  # สัดส่วนเวลาสูงสุดที่ใช้เขียน workbook (ไฟล์ยิ่งใหญ่ยิ่งเว้นห่าง)
 MAX_QUEUE_SIZE = 100  # ขนาดสูงสุดของคิวสำหรับการบันทึกข้อมูล
+DISPLAY_SIZE = (640, 480)  # ความละเอียดของสตรีมแสดงผล
+ANALYSIS_SIZE = (320, 240)  # ความละเอียดของสตรีมวิเคราะห์ (Haar + emotion)
+THREAD_BUDGET_FILE = "thread_budget.json"  # ค่าเธรด/affinity ที่แนะนำจาก benchmark
+BENCHMARK_FRAMES = 300  # จำนวนเฟรมต่อการวัดหนึ่งค่าตั้ง
+CAPTURE_STALL_TIMEOUT = 2.0  # วินาทีที่ไม่มีเฟรมใหม่ก่อนถือว่ากล้องค้าง
+CAPTURE_FROZEN_TIMEOUT = 5.0  # วินาทีที่ภาพเหมือนเดิมทุกเฟรมก่อนถือว่าภาพนิ่ง
+CAPTURE_MAX_ERRORS = 5  # จำนวนข้อผิดพลาดติดกันก่อนเชื่อมต่อใหม่
+CAPTURE_BACKOFF_INITIAL = 0.5  # วินาทีรอก่อนลองเชื่อมต่อใหม่ครั้งถัดไป (เพิ่มเป็นสองเท่า)
+CAPTURE_BACKOFF_MAX = 30.0
+CAPTURE_FAILOVER_AFTER = 3  # จำนวนครั้งที่ลอง backend เดิมก่อนสลับไป backend อื่น
+CAPTURE_JOIN_TIMEOUT = 0.5  # วินาทีที่รอเธรดจับภาพเดิมออกก่อนปิดกล้อง (read ค้างจะถูกปล่อยให้เธรดปิดเอง)
+FRAME_WAIT_TIMEOUT = 0.1  # วินาทีที่ get_frame รอเฟรมใหม่
+CAMERA_DISCOVERY_TIMEOUT = 5.0  # วินาทีสูงสุดในการ probe กล้องทั้งหมด
+CAMERA_PRIORITY_GRACE = 1.0  # วินาทีที่รอกลุ่มลำดับสูงกว่าหลังมีกลุ่มอื่น probe สำเร็จแล้ว
+CAMERA_CACHE_FILE = "camera_cache.json"  # backend/ค่าตั้งล่าสุดที่ใช้งานได้
+INFERENCE_PORT = 8765  # พอร์ตเริ่มต้นของเซิร์ฟเวอร์วิเคราะห์อารมณ์
+MAX_INFERENCE_BATCH = 32  # จำนวนภาพสูงสุดต่อคำขอ
+MAX_INFERENCE_BODY_BYTES = 8 * 1024 * 1024  # ขนาด body สูงสุดที่เซิร์ฟเวอร์ยอมอ่าน
+CLIP_PRE_ROLL_SECONDS = 3  # วินาทีก่อนเหตุการณ์ที่เก็บไว้ในคลิป
+CLIP_POST_ROLL_SECONDS = 3  # วินาทีหลังเหตุการณ์
+CLIP_MAX_SECONDS = 30  # ความยาวคลิปสูงสุด แม้จะมีเหตุการณ์ต่อเนื่อง
+CLIP_FPS = 10  # อัตราเฟรมของคลิป (ลดจำนวนเฟรมที่ต้องเข้ารหัส)
+CLIP_JPEG_QUALITY = 80
+CLIP_WRITER_THREADS = 2  # จำนวนเธรดเข้ารหัส/เขียนไฟล์
+CLIP_MAX_PENDING_ENCODES = 8  # ทิ้งเฟรมถ้างานเข้ารหัสค้างเกินนี้
+CLIP_NEGATIVE_CONFIDENCE = 70.0  # ความมั่นใจขั้นต่ำของอารมณ์ลบที่ทริกเกอร์คลิป
+CLIP_MAX_FILES = 200  # จำนวนคลิปสูงสุดที่เก็บไว้ (ลบคลิปเก่าสุดก่อน)
+CLIP_MAX_MB = 500  # ขนาดรวมสูงสุดของโฟลเดอร์คลิป
+NEGATIVE_EMOTIONS = {"Angry", "Disgust", "Fear", "Sad"}
+HISTORY_CAPACITY = 262_144  # จำนวนเรคอร์ดในหน่วยความจำ (~4 MB, หลายชั่วโมงที่ ~10 ครั้ง/วินาที)
+REPORT_CHUNK_SIZE = 500_000  # จำนวนแถวต่อ chunk เมื่ออ่าน log ขนาดใหญ่
+SOAK_SAMPLE_INTERVAL = 300  # วินาที (เวลาจำลอง) ระหว่าง snapshot หน่วยความจำ/latency
+SOAK_MAX_RSS_GROWTH_MB = 50.0  # RSS ที่เพิ่มขึ้นได้สูงสุดหลัง warm-up
+SOAK_MAX_TRACED_GROWTH_MB = 20.0  # หน่วยความจำ Python (tracemalloc) ที่เพิ่มขึ้นได้สูงสุด
+SOAK_MAX_LATENCY_DRIFT = 1.5  # อัตราส่วน p95 latency ช่วงสุดท้ายต่อช่วงแรกที่ยอมรับได้
+SOAK_MAX_DROPPED_RATIO = 0.01  # สัดส่วนข้อมูลที่ถูกทิ้งเพราะคิวเต็มที่ยอมรับได้
+SOAK_MIN_SAMPLES = 6  # จำนวน snapshot ขั้นต่ำหลัง warm-up (ย่อ sample_interval ให้พอเสมอ)
+
+# สร้าง style ครั้งเดียว (Alignment ใหม่ทุกเซลล์ทำให้เธรดบันทึกช้ากว่าอัตราการตรวจจับ)
+CENTER_ALIGNMENT = Alignment(horizontal='center')
+
+# คอลัมน์ของ log การตรวจจับ (ลำดับเดียวกับแถวใน Excel)
+LOG_COLUMNS = [
+    "date", "time", "emotion", "confidence",
+    "satisfaction_level", "satisfaction_text", "camera_method"
+]
 
 try:
     from picamera2 import Picamera2
@@ -39,63 +98,1299 @@ except ImportError:
     print("⚠️ DeepFace not installed. Using simple face detection only.")
     print("Install with: pip install deepface tensorflow")
 
-class RaspberryPi4CameraDetector:
+EMOTION_MAP = {
+    'angry': 'Angry',
+    'disgust': 'Disgust',
+    'fear': 'Fear',
+    'happy': 'Happy',
+    'sad': 'Sad',
+    'surprise': 'Surprise',
+    'neutral': 'Neutral'
+}
+
+def analyze_emotion_local(frame_bgr):
+    """วิเคราะห์อารมณ์ด้วย DeepFace บนเครื่องนี้ คืนค่า (อารมณ์, ความมั่นใจ) หรือ None"""
+    result = DeepFace.analyze(
+        frame_bgr, 
+        actions=['emotion'], 
+        enforce_detection=False,
+        silent=True
+    )
+    
+    if isinstance(result, list) and len(result) > 0:
+        emotion = result[0]['dominant_emotion']
+        confidence = float(result[0]['emotion'][emotion])
+        return EMOTION_MAP.get(emotion, emotion), confidence
+    return None
+
+# โครงสร้างเรคอร์ดแบบ packed: 15 ไบต์ต่อการตรวจจับหนึ่งครั้ง
+HISTORY_DTYPE = np.dtype([
+    ("timestamp_ms", "<i8"),
+    ("emotion", "u1"),
+    ("confidence", "<f4"),
+    ("satisfaction", "u1"),
+    ("camera", "u1"),
+])
+
+class EmotionHistory:
+    """ประวัติการตรวจจับแบบ ring buffer บน NumPy structured array ที่จองไว้ล่วงหน้า
+
+    เก็บเวลาเป็นจำนวนเต็ม (มิลลิวินาที) และอารมณ์/กล้องเป็นรหัสตัวเลข
+    ทำให้เก็บได้หลายชั่วโมงในไม่กี่ MB และ query แบบ vectorized ได้
+    """
+
+    def __init__(self, capacity=HISTORY_CAPACITY):
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=HISTORY_DTYPE)
+        self._next = 0
+        self._size = 0
+        self.emotion_names = list(EMOTION_MAP.values()) + ["No Face"]
+        self._emotion_codes = {name: code for code, name in enumerate(self.emotion_names)}
+        self.camera_names = []
+        self._camera_codes = {}
+
+    def _code(self, value, names, codes):
+        code = codes.get(value)
+        if code is None:
+            if len(names) >= 255:
+                raise ValueError("too many distinct labels for uint8 codes")
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def append(self, emotion, confidence, satisfaction=0, camera=None, timestamp=None):
+        """เพิ่มเรคอร์ดหนึ่งรายการ (เขียนทับรายการเก่าสุดเมื่อเต็ม)"""
+        timestamp = time.time() if timestamp is None else timestamp
+        self._data[self._next] = (
+            int(timestamp * 1000),
+            self._code(emotion, self.emotion_names, self._emotion_codes),
+            confidence,
+            satisfaction,
+            self._code(str(camera), self.camera_names, self._camera_codes),
+        )
+        self._next = (self._next + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def __len__(self):
+        return self._size
+
+    def records(self):
+        """คืนค่าเรคอร์ดทั้งหมดเรียงตามเวลา"""
+        if self._size < self.capacity:
+            return self._data[:self._size]
+        return np.concatenate((self._data[self._next:], self._data[:self._next]))
+
+    def since(self, seconds, now=None):
+        """คืนค่าเรคอร์ดในช่วง `seconds` วินาทีล่าสุด"""
+        now = time.time() if now is None else now
+        records = self.records()
+        return records[records["timestamp_ms"] >= int((now - seconds) * 1000)]
+
+    def counts(self, records=None):
+        """จำนวนครั้งของแต่ละอารมณ์ {ชื่ออารมณ์: จำนวน}"""
+        records = self.records() if records is None else records
+        counts = np.bincount(records["emotion"], minlength=len(self.emotion_names))
+        return {self.emotion_names[code]: int(n) for code, n in enumerate(counts) if n}
+
+    def mean_confidence(self, emotion=None, records=None):
+        records = self.records() if records is None else records
+        if emotion is not None:
+            records = records[records["emotion"] == self._emotion_codes.get(emotion, -1)]
+        return float(records["confidence"].mean()) if len(records) else 0.0
+
+    def to_dataframe(self):
+        """แปลงเป็น DataFrame พร้อมถอดรหัสอารมณ์/กล้อง"""
+        records = self.records()
+        return pd.DataFrame({
+            "timestamp": pd.to_datetime(records["timestamp_ms"], unit="ms"),
+            "emotion": pd.Categorical.from_codes(records["emotion"], self.emotion_names),
+            "confidence": records["confidence"],
+            "satisfaction": records["satisfaction"],
+            "camera": pd.Categorical.from_codes(records["camera"], self.camera_names),
+        })
+
+def lores_to_bgr(yuv, size, grayscale=False):
+    """แปลงเฟรม lores (YUV420/I420) ของ PiCamera2 เป็น BGR"""
+    width, height = size
+    stride = yuv.shape[1]
+    if grayscale:
+        return cv2.cvtColor(np.ascontiguousarray(yuv[:height, :width]), cv2.COLOR_GRAY2BGR)
+    if stride != width:
+        # PiCamera2 อาจเติม padding ให้ stride กว้างกว่าภาพจริง ระนาบ U/V มี stride ครึ่งหนึ่ง
+        # และเรียงต่อกันในแถวของ array จึงต้องตัดแต่ละระนาบแยกกัน
+        flat = yuv.reshape(-1)
+        y_size = stride * height
+        uv_size = (stride // 2) * (height // 2)
+        y = flat[:y_size].reshape(height, stride)[:, :width]
+        u = flat[y_size:y_size + uv_size].reshape(height // 2, stride // 2)[:, :width // 2]
+        v = flat[y_size + uv_size:y_size + 2 * uv_size].reshape(height // 2, stride // 2)[:, :width // 2]
+        yuv = np.concatenate([y.ravel(), u.ravel(), v.ravel()]).reshape(height * 3 // 2, width)
+    return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+
+def downscale_frame(frame, size=ANALYSIS_SIZE):
+    """ย่อเฟรมด้วยซอฟต์แวร์สำหรับแหล่งภาพที่ไม่มีสตรีม lores"""
+    width, height = size
+    if frame.shape[1] <= width and frame.shape[0] <= height:
+        return frame
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+def scale_boxes(boxes, src_shape, dst_shape):
+    """แปลงพิกัดกรอบจากเฟรมวิเคราะห์กลับไปเป็นพิกัดเฟรมแสดงผล"""
+    sx = dst_shape[1] / src_shape[1]
+    sy = dst_shape[0] / src_shape[0]
+    return [
+        (int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy)))
+        for (x, y, w, h) in boxes
+    ]
+
+class FaultInjector:
+    """จำลองความผิดพลาดของกล้องตามช่วงเวลา ใช้ร่วมกันทุก handle ของอุปกรณ์เดียวกัน
+
+    ชนิด: error (read คืน False), exception (read โยน exception), hang (read ค้าง),
+    freeze (คืนภาพเดิม), disconnect (อุปกรณ์หายไป เปิดใหม่ไม่ได้)
+    """
+    KINDS = ("error", "exception", "hang", "freeze", "disconnect")
+
     def __init__(self):
+        self._faults = []  # (ชนิด, เวลาสิ้นสุด)
+        self._lock = threading.Lock()
+
+    def inject(self, kind, duration):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown fault: {kind}")
+        with self._lock:
+            self._faults.append((kind, time.time() + duration))
+
+    def active(self, kind):
+        now = time.time()
+        with self._lock:
+            self._faults = [fault for fault in self._faults if fault[1] > now]
+            return any(name == kind for name, _ in self._faults)
+
+    def clear(self):
+        with self._lock:
+            self._faults = []
+
+class SimulatedCamera:
+    """กล้องจำลองที่มีอินเทอร์เฟซแบบ cv2.VideoCapture สำหรับทดสอบโดยไม่มีฮาร์ดแวร์
+
+    realtime=True จะหน่วง read() ตาม fps เหมือนกล้องจริง ส่วน realtime=False
+    (soak test/benchmark) ให้เฟรมทันทีและเธรดจับภาพทำงานแบบ lockstep กับผู้ใช้เฟรม
+    """
+
+    def __init__(self, source=None, size=DISPLAY_SIZE, fps=30, realtime=True, faults=None):
+        self.size = size
+        self.fps = fps
+        self.realtime = realtime
+        self.lockstep = not realtime
+        self.faults = faults
+        self.frame_index = 0
+        self._source = None
+        self._still = None
+        self._opened = True
+        self._last_frame = None
+        self._next_frame_time = 0.0
+
+        # ใช้ไฟล์วิดีโอ/รูปภาพเป็นแหล่งภาพถ้ากำหนดไว้ ไม่เช่นนั้นสร้างภาพสังเคราะห์
+        if source:
+            still = cv2.imread(source)
+            if still is not None:
+                self._still = cv2.resize(still, size)
+            else:
+                self._source = cv2.VideoCapture(source)
+                self._opened = self._source.isOpened()
+
+    def isOpened(self):
+        if self.faults is not None and self.faults.active("disconnect"):
+            return False
+        return self._opened
+
+    def _pace(self):
+        if not self.realtime:
+            return
+        now = time.time()
+        if self._next_frame_time > now:
+            time.sleep(self._next_frame_time - now)
+        self._next_frame_time = max(now, self._next_frame_time) + 1.0 / self.fps
+
+    def _synthetic_frame(self):
+        """สร้างเฟรมสังเคราะห์ที่เปลี่ยนแปลงทุกเฟรม"""
+        width, height = self.size
+        frame = np.full((height, width, 3), 40, dtype=np.uint8)
+        t = self.frame_index / self.fps
+        cx = int(width / 2 + (width / 4) * np.sin(t))
+        cy = height // 2
+        cv2.ellipse(frame, (cx, cy), (60, 80), 0, 0, 360, (150, 180, 220), -1)
+        cv2.circle(frame, (cx - 22, cy - 20), 8, (40, 40, 40), -1)
+        cv2.circle(frame, (cx + 22, cy - 20), 8, (40, 40, 40), -1)
+        cv2.ellipse(frame, (cx, cy + 30), (25, 10), 0, 0, 180, (40, 40, 120), 3)
+        return frame
+
+    def read(self):
+        if not self.isOpened():
+            return False, None
+
+        if self.faults is not None:
+            # ค้างเหมือนไดรเวอร์ไม่ตอบสนอง จนกว่า fault หมดเวลาหรือถูก release
+            while self.faults.active("hang") and self._opened:
+                time.sleep(0.05)
+            if self.faults.active("exception"):
+                raise RuntimeError("injected capture fault")
+            if self.faults.active("error"):
+                return False, None
+            if self.faults.active("freeze") and self._last_frame is not None:
+                self._pace()
+                return True, self._last_frame.copy()
+
+        self._pace()
+        if self._still is not None:
+            frame = self._still.copy()
+        elif self._source is not None:
+            ret, frame = self._source.read()
+            if not ret:
+                # วนกลับไปต้นวิดีโอ
+                self._source.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ret, frame = self._source.read()
+                if not ret:
+                    return False, None
+            frame = cv2.resize(frame, self.size)
+        else:
+            frame = self._synthetic_frame()
+
+        self.frame_index += 1
+        self._last_frame = frame
+        return True, frame
+
+    def set(self, prop, value):
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.size[0])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.size[1])
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            # เวลาของเฟรมล่าสุด: เดินต่อแม้ภาพนิ่ง แต่หยุดเมื่อ freeze คืนเฟรมเดิมซ้ำ
+            return self.frame_index * 1000.0 / self.fps
+        return 0.0
+
+    def release(self):
+        self._opened = False
+        if self._source is not None:
+            self._source.release()
+
+def encode_face_crops(crops, encoding="jpeg"):
+    """เข้ารหัสภาพใบหน้าหลายภาพเป็น payload JSON สำหรับส่งไปเซิร์ฟเวอร์"""
+    items = []
+    for crop in crops:
+        if encoding == "jpeg":
+            ok, buf = cv2.imencode('.jpg', crop, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            if not ok:
+                raise ValueError("JPEG encoding failed")
+            items.append({"format": "jpeg", "data": base64.b64encode(buf).decode("ascii")})
+        elif encoding == "raw":
+            crop = np.ascontiguousarray(crop, dtype=np.uint8)
+            items.append({
+                "format": "raw",
+                "shape": list(crop.shape),
+                "data": base64.b64encode(crop.tobytes()).decode("ascii")
+            })
+        else:
+            raise ValueError(f"Unknown encoding: {encoding}")
+    return json.dumps({"items": items}).encode("utf-8")
+
+def decode_face_crops(payload):
+    """ถอดรหัส payload JSON กลับเป็นรายการภาพ BGR"""
+    return decode_face_items(json.loads(payload)["items"])
+
+def decode_face_items(items):
+    """ถอดรหัสรายการภาพจาก payload ที่ parse JSON แล้ว"""
+    crops = []
+    for item in items:
+        data = base64.b64decode(item["data"])
+        if item["format"] == "jpeg":
+            crop = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if crop is None:
+                raise ValueError("Invalid JPEG data")
+        elif item["format"] == "raw":
+            crop = np.frombuffer(data, dtype=np.uint8).reshape(item["shape"])
+        else:
+            raise ValueError(f"Unknown format: {item['format']}")
+        crops.append(crop)
+    return crops
+
+class _InferenceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP handler ของเซิร์ฟเวอร์วิเคราะห์อารมณ์ (keep-alive)"""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.engine._track_connection(self.connection, True)
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            self.server.engine._track_connection(self.connection, False)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "deepface": DEEPFACE_AVAILABLE})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/analyze":
+            self._send_json(404, {"error": "not found"})
+            return
+        
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_INFERENCE_BODY_BYTES:
+            # ไม่อ่าน body ที่ใหญ่เกิน จึงต้องปิด connection หลังตอบ
+            self.close_connection = True
+            status = 400 if length < 0 else 413
+            self._send_json(status, {"error": f"body must be 0-{MAX_INFERENCE_BODY_BYTES} bytes"})
+            return
+        
+        payload = self.rfile.read(length)
+        try:
+            items = json.loads(payload)["items"]
+            # ตรวจจำนวนก่อนถอดรหัสภาพ ไม่ให้ batch ใหญ่กินหน่วยความจำ/CPU
+            if len(items) > MAX_INFERENCE_BATCH:
+                self._send_json(413, {"error": f"batch larger than {MAX_INFERENCE_BATCH}"})
+                return
+            crops = decode_face_items(items)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+            return
+        
+        try:
+            results = self.server.engine.analyze_batch(crops)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"results": results})
+
+    def log_message(self, format, *args):
+        pass
+
+class EmotionInferenceServer:
+    """เซิร์ฟเวอร์ HTTP ในเครือข่ายที่ให้บริการวิเคราะห์อารมณ์แบบ batch"""
+
+    def __init__(self, host="0.0.0.0", port=INFERENCE_PORT, analyze_fn=None):
+        self.analyze_fn = analyze_fn or analyze_emotion_local
+        self._engine_lock = threading.Lock()  # TensorFlow model ใช้ได้ทีละเธรด
+        self.httpd = ThreadingHTTPServer((host, port), _InferenceRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.engine = self
+        self._thread = None
+        self._connections = set()  # socket ของไคลเอนต์ที่เปิด keep-alive อยู่
+        self._connections_lock = threading.Lock()
+
+    def _track_connection(self, connection, opened):
+        with self._connections_lock:
+            if opened:
+                self._connections.add(connection)
+            else:
+                self._connections.discard(connection)
+
+    @property
+    def address(self):
+        return self.httpd.server_address[:2]
+
+    def analyze_batch(self, crops):
+        """วิเคราะห์ภาพทั้ง batch คืนค่ารายการผลลัพธ์"""
+        results = []
+        with self._engine_lock:
+            for crop in crops:
+                analyzed = self.analyze_fn(crop)
+                if analyzed is None:
+                    results.append({"emotion": None, "confidence": 0.0})
+                else:
+                    results.append({"emotion": analyzed[0], "confidence": float(analyzed[1])})
+        return results
+
+    def serve_forever(self):
+        host, port = self.address
+        print(f"🛰️ Emotion inference server listening on {host}:{port}")
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\n⚠️ Interrupted by user")
+        finally:
+            self.httpd.server_close()
+
+    def start(self):
+        """เริ่มเซิร์ฟเวอร์ในเธรดพื้นหลัง"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """หยุดรับ connection ใหม่และตัด connection keep-alive ที่ค้างอยู่"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        with self._connections_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread:
+            self._thread.join(timeout=2)
+
+class InferenceServerError(Exception):
+    """เซิร์ฟเวอร์ตอบกลับด้วยข้อผิดพลาด (HTTP ไม่ใช่ 200) แต่เครือข่ายยังใช้ได้"""
+
+    def __init__(self, status, message):
+        super().__init__(f"server returned HTTP {status}: {message}")
+        self.status = status
+
+class RemoteEmotionClient:
+    """ไคลเอนต์สำหรับส่งภาพไปวิเคราะห์ที่เซิร์ฟเวอร์ พร้อม connection pool และคำขอค้างหลายรายการ"""
+
+    def __init__(self, host, port=INFERENCE_PORT, pool_size=2, timeout=2.0,
+                 retry_interval=5.0, encoding="jpeg"):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.encoding = encoding
+        self._pool = queue.LifoQueue()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="remote-infer")
+        self._pending = deque()
+        self._down_until = 0.0
+
+    @property
+    def available(self):
+        """False ระหว่างช่วงพักหลังเชื่อมต่อเซิร์ฟเวอร์ไม่สำเร็จ"""
+        return time.time() >= self._down_until
+
+    def _post(self, conn, body):
+        conn.request("POST", "/analyze", body=body,
+                     headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        payload = response.read()
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            data = {}
+        if response.status != 200 or "results" not in data:
+            raise InferenceServerError(response.status, data.get("error", "invalid response"))
+        return data["results"]
+
+    def analyze_batch(self, crops):
+        """ส่งภาพหลายภาพ คืนค่ารายการ dict {emotion, confidence}
+
+        แบ่งเป็นคำขอละไม่เกิน MAX_INFERENCE_BATCH ภาพตามที่เซิร์ฟเวอร์รับได้
+        """
+        if not self.available:
+            raise ConnectionError("inference server marked unavailable")
+        
+        results = []
+        for start in range(0, len(crops), MAX_INFERENCE_BATCH):
+            results.extend(self._request(crops[start:start + MAX_INFERENCE_BATCH]))
+        return results
+
+    def _request(self, crops):
+        """ส่งหนึ่งคำขอผ่าน connection ใน pool
+
+        เฉพาะความผิดพลาดของเครือข่ายเท่านั้นที่ทำให้พักการเชื่อมต่อ retry_interval วินาที
+        ส่วน HTTP error จากเซิร์ฟเวอร์โยน InferenceServerError และคืน connection เข้า pool
+        """
+        body = encode_face_crops(crops, self.encoding)
+        try:
+            conn = self._pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            reused = False
+        
+        try:
+            try:
+                results = self._post(conn, body)
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # การเชื่อมต่อเก่าใน pool อาจถูกเซิร์ฟเวอร์ปิดไปแล้ว ลองใหม่หนึ่งครั้ง
+                if not reused:
+                    raise
+                conn.close()
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                results = self._post(conn, body)
+        except InferenceServerError:
+            # อ่าน response ครบแล้ว connection ยังใช้ต่อได้
+            self._pool.put(conn)
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            self._down_until = time.time() + self.retry_interval
+            raise ConnectionError(f"inference server unreachable: {e}") from e
+        
+        self._pool.put(conn)
+        return results
+
+    def submit(self, crops):
+        """ส่งคำขอแบบไม่รอผล คืนค่า Future"""
+        return self._executor.submit(self.analyze_batch, crops)
+
+    def analyze_latest(self, crop):
+        """ส่งเฟรมใหม่เข้าไปประมวลผลและคืนผลล่าสุดที่เสร็จแล้ว (None ถ้ายังไม่มี)
+
+        คำขอค้างได้สูงสุด pool_size รายการ ทำให้ลูปหลักไม่ต้องรอ round-trip ของเครือข่าย
+        """
+        if not self.available:
+            raise ConnectionError("inference server marked unavailable")
+        
+        latest = None
+        while self._pending and self._pending[0].done():
+            latest = self._pending.popleft().result()[0]
+        
+        if len(self._pending) < self.pool_size:
+            self._pending.append(self.submit([crop]))
+        return latest
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._pending.clear()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+def parse_core_list(spec):
+    """แปลงสตริง core เช่น "0", "1-2", "0+3" เป็นเซตของหมายเลข core"""
+    cores = set()
+    for part in spec.split("+"):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if "-" in part:
+                first, last = (int(value) for value in part.split("-"))
+                if first > last:
+                    raise ValueError
+                cores.update(range(first, last + 1))
+            else:
+                cores.add(int(part))
+        except ValueError:
+            raise ValueError(f"Invalid core list: {spec!r}") from None
+    if not cores or min(cores) < 0:
+        raise ValueError(f"Invalid core list: {spec!r}")
+    return cores
+
+def parse_affinity_spec(spec):
+    """แปลง "capture=0,inference=1-2,persistence=3" เป็น {บทบาท: [core, ...]}"""
+    affinity = {}
+    for item in spec.split(","):
+        role, _, cores = item.partition("=")
+        role = role.strip()
+        if role not in ThreadBudget.ROLES:
+            raise ValueError(f"Unknown thread role: {role}")
+        affinity[role] = sorted(parse_core_list(cores.strip()))
+    return affinity
+
+def affinity_spec_argument(spec):
+    """ตัวแปลงสำหรับ argparse: แจ้งข้อผิดพลาดของ --pin เป็นข้อความ usage แทน traceback"""
+    try:
+        return parse_affinity_spec(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+class ThreadBudget:
+    """กำหนดจำนวนเธรดของ OpenCV/TensorFlow และผูกเธรดแต่ละบทบาทกับ CPU core
+
+    ค่า None หมายถึงใช้ค่าเริ่มต้นของไลบรารี บทบาทของเธรดคือ capture (เธรดจับภาพ),
+    inference (ลูปหลักที่ตรวจจับ/วิเคราะห์) และ persistence (บันทึก Excel และคลิป)
+    """
+    ROLES = ("capture", "inference", "persistence")
+
+    def __init__(self, cv_threads=None, tf_intra=None, tf_inter=None, affinity=None):
+        self.cv_threads = cv_threads
+        self.tf_intra = tf_intra
+        self.tf_inter = tf_inter
+        self.affinity = affinity or {}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("cv_threads"), data.get("tf_intra"),
+                   data.get("tf_inter"), data.get("affinity"))
+
+    def to_dict(self):
+        return {"cv_threads": self.cv_threads, "tf_intra": self.tf_intra,
+                "tf_inter": self.tf_inter, "affinity": self.affinity}
+
+    def describe(self):
+        pins = ",".join(f"{role}={'+'.join(map(str, cores))}" for role, cores in self.affinity.items())
+        return (f"cv={self.cv_threads or 'default'} tf_intra={self.tf_intra or 'default'} "
+                f"tf_inter={self.tf_inter or 'default'} pin={pins or 'none'}")
+
+    def apply(self):
+        """ตั้งค่าจำนวนเธรดของ OpenCV และ TensorFlow (ควรเรียกก่อนโหลดโมเดล)"""
+        if self.cv_threads is not None:
+            cv2.setNumThreads(self.cv_threads)
+        
+        if DEEPFACE_AVAILABLE and (self.tf_intra is not None or self.tf_inter is not None):
+            try:
+                import tensorflow as tf
+                if self.tf_intra is not None:
+                    tf.config.threading.set_intra_op_parallelism_threads(self.tf_intra)
+                if self.tf_inter is not None:
+                    tf.config.threading.set_inter_op_parallelism_threads(self.tf_inter)
+            except (ImportError, RuntimeError) as e:
+                # TensorFlow ไม่ยอมให้เปลี่ยนค่าหลัง runtime เริ่มทำงานแล้ว
+                print(f"⚠️ Cannot set TensorFlow thread counts: {e}")
+
+    def pin(self, role):
+        """ผูกเธรดปัจจุบันกับ core ของบทบาทนั้น (Linux เท่านั้น)"""
+        cores = self.affinity.get(role)
+        if not cores or not hasattr(os, "sched_setaffinity"):
+            return False
+        available = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set(cores)
+        cores = set(cores) & set(available)
+        if not cores:
+            return False
+        try:
+            # บน Linux affinity เป็นของแต่ละเธรด เธรดที่สร้างใหม่จะสืบทอดค่านี้
+            os.sched_setaffinity(threading.get_native_id(), cores)
+            return True
+        except OSError as e:
+            print(f"⚠️ Cannot pin {role} thread: {e}")
+            return False
+
+def load_thread_budget(path=THREAD_BUDGET_FILE):
+    """อ่านค่าเธรดที่บันทึกไว้จาก benchmark (ถ้ามี)"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return ThreadBudget.from_dict(json.load(f))
+    except (OSError, ValueError):
+        return ThreadBudget()
+
+class ClipRecorder:
+    """บันทึกคลิปรอบเหตุการณ์ โดยเก็บ pre-roll เป็น JPEG ใน ring buffer และเขียนไฟล์ในเธรดพื้นหลัง
+
+    ลูปหลักเพียงส่งสำเนาเฟรมเข้า executor งานเข้ารหัส JPEG และการเขียนดิสก์ทั้งหมด
+    ทำใน writer pool คลิปถูกเขียนเป็น MJPEG (JPEG ต่อกัน) จึงไม่ต้องเข้ารหัสซ้ำ
+    """
+
+    def __init__(self, output_dir="clips", pre_roll=CLIP_PRE_ROLL_SECONDS,
+                 post_roll=CLIP_POST_ROLL_SECONDS, max_length=CLIP_MAX_SECONDS, fps=CLIP_FPS,
+                 quality=CLIP_JPEG_QUALITY, writers=CLIP_WRITER_THREADS,
+                 max_pending=CLIP_MAX_PENDING_ENCODES, max_clips=CLIP_MAX_FILES,
+                 max_bytes=CLIP_MAX_MB * 1024 * 1024, thread_initializer=None):
+        self.output_dir = output_dir
+        self.max_clips = max_clips
+        self.max_bytes = max_bytes
+        self.clips_deleted = 0
+        self._retention_lock = threading.Lock()
+        self.post_roll = post_roll
+        self.max_length = max_length
+        self.frame_interval = 1.0 / fps
+        self.quality = quality
+        self.max_pending = max_pending
+        self.ring = deque(maxlen=max(1, int(pre_roll * fps)))  # (timestamp, Future[bytes])
+        self.active_clip = None
+        self.clips_written = 0
+        self.dropped_frames = 0
+        self._last_frame_time = 0.0
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=writers, thread_name_prefix="clip-writer",
+                                            initializer=thread_initializer)
+
+    def _encode(self, frame):
+        try:
+            ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            return buf.tobytes() if ok else None
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+    def add_frame(self, frame, now=None):
+        """ส่งเฟรมเข้า ring buffer (ลดอัตราเฟรมตาม fps และทิ้งเฟรมถ้างานค้าง)"""
+        now = time.time() if now is None else now
+        # ปิดคลิปที่ครบเวลาก่อนเสมอ แม้เฟรมนี้จะถูกข้าม ไม่งั้นคลิปยืดยาวและกลืนทริกเกอร์ถัดไป
+        self._finish_if_due(now)
+        if now - self._last_frame_time < self.frame_interval:
+            return
+        
+        with self._pending_lock:
+            if self._pending >= self.max_pending:
+                self.dropped_frames += 1
+                return
+            self._pending += 1
+        
+        self._last_frame_time = now
+        entry = (now, self._executor.submit(self._encode, frame.copy()))
+        self.ring.append(entry)
+        if self.active_clip is not None:
+            self.active_clip["frames"].append(entry)
+
+    def trigger(self, reason, now=None):
+        """เริ่มคลิปใหม่ (พร้อม pre-roll) หรือยืดเวลาคลิปที่กำลังบันทึก"""
+        now = time.time() if now is None else now
+        if self.active_clip is not None:
+            # ยืดเวลาได้ไม่เกิน max_length เพื่อไม่ให้คลิปยาว (และกินหน่วยความจำ) ไม่สิ้นสุด
+            self.active_clip["end_time"] = min(
+                now + self.post_roll, self.active_clip["start_time"] + self.max_length
+            )
+            return False
+        
+        self.active_clip = {
+            "reason": reason,
+            "start_time": now,
+            "end_time": now + self.post_roll,
+            "frames": list(self.ring),
+        }
+        print(f"🎬 Clip triggered: {reason}")
+        return True
+
+    def _finish_if_due(self, now):
+        if self.active_clip is not None and now >= self.active_clip["end_time"]:
+            self._finish_clip()
+
+    def _finish_clip(self):
+        clip, self.active_clip = self.active_clip, None
+        stamp = datetime.fromtimestamp(clip["start_time"]).strftime("%Y%m%d_%H%M%S")
+        filename = os.path.join(self.output_dir, f"clip_{stamp}_{clip['reason']}.mjpeg")
+        self._executor.submit(self._write_clip, filename, clip["frames"])
+
+    def _write_clip(self, filename, frames):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(filename, "wb") as f:
+                for _, future in frames:
+                    data = future.result()
+                    if data:
+                        f.write(data)
+            self.clips_written += 1
+            print(f"🎞️ Clip saved: {filename} ({len(frames)} frames)")
+            self._enforce_retention()
+        except Exception as e:
+            print(f"❌ เกิดข้อผิดพลาดในการบันทึกคลิป: {e}")
+
+    def _enforce_retention(self):
+        """ลบคลิปเก่าสุดจนจำนวนและขนาดรวมไม่เกิน max_clips / max_bytes"""
+        with self._retention_lock:
+            clips = []
+            for entry in os.scandir(self.output_dir):
+                if entry.is_file() and entry.name.startswith("clip_") and entry.name.endswith(".mjpeg"):
+                    stat = entry.stat()
+                    clips.append((stat.st_mtime, stat.st_size, entry.path))
+            clips.sort()
+            total = sum(size for _, size, _ in clips)
+            while clips and (len(clips) > self.max_clips or total > self.max_bytes):
+                _, size, path = clips.pop(0)
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.clips_deleted += 1
+
+    def save_snapshot(self, frame, filename):
+        """บันทึกรูปภาพในเธรดพื้นหลัง"""
+        def write():
+            try:
+                if cv2.imwrite(filename, frame):
+                    print(f"📸 Screenshot saved: {filename}")
+                else:
+                    print(f"❌ Failed to save screenshot: {filename}")
+            except Exception as e:
+                print(f"❌ เกิดข้อผิดพลาดในการบันทึกรูปภาพ: {e}")
+        
+        self._executor.submit(write)
+
+    def close(self):
+        """เขียนคลิปที่ค้างอยู่และรอให้งานทั้งหมดเสร็จ"""
+        if self.active_clip is not None:
+            self._finish_clip()
+        self._executor.shutdown(wait=True)
+        self.ring.clear()
+
+def iter_log_chunks(path, chunksize=REPORT_CHUNK_SIZE):
+    """อ่าน log การตรวจจับ (CSV หรือ Excel) ทีละ chunk เพื่อไม่ต้องโหลดทั้งไฟล์เข้าหน่วยความจำ"""
+    dtypes = {"emotion": "category", "camera_method": "category",
+              "satisfaction_level": "float32", "confidence": "float32"}
+    
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        # openpyxl โหมด read_only อ่านทีละแถวแบบ streaming
+        wb = openpyxl.load_workbook(path, read_only=True)
+        try:
+            rows = []
+            for row in wb.active.iter_rows(min_row=2, max_col=len(LOG_COLUMNS), values_only=True):
+                if row[0] is None:
+                    continue
+                rows.append(row)
+                if len(rows) >= chunksize:
+                    yield _normalize_log_chunk(pd.DataFrame(rows, columns=LOG_COLUMNS), dtypes)
+                    rows = []
+            if rows:
+                yield _normalize_log_chunk(pd.DataFrame(rows, columns=LOG_COLUMNS), dtypes)
+        finally:
+            wb.close()
+        return
+    
+    reader = pd.read_csv(
+        path, header=0, names=LOG_COLUMNS, usecols=range(len(LOG_COLUMNS)),
+        dtype={"date": str, "time": str, "satisfaction_text": str},
+        chunksize=chunksize, memory_map=True
+    )
+    for chunk in reader:
+        yield _normalize_log_chunk(chunk, dtypes)
+
+def _normalize_log_chunk(chunk, dtypes):
+    """แปลงชนิดข้อมูลของ chunk ให้เหมาะกับการคำนวณแบบ vectorized"""
+    chunk["confidence"] = pd.to_numeric(chunk["confidence"], errors="coerce")
+    chunk["satisfaction_level"] = pd.to_numeric(chunk["satisfaction_level"], errors="coerce")
+    chunk = chunk.astype(dtypes)
+    chunk["date"] = chunk["date"].astype(str)
+    # ชั่วโมงจากสตริง HH:MM:SS โดยไม่ต้อง parse datetime ทั้งคอลัมน์
+    chunk["hour"] = pd.to_numeric(chunk["time"].astype(str).str[:2], errors="coerce").astype("Int8")
+    return chunk
+
+def summarize_emotion_log(path, chunksize=REPORT_CHUNK_SIZE):
+    """คำนวณสรุปสถิติจาก log โดยรวมผลบางส่วนของแต่ละ chunk"""
+    hourly, daily, cameras, camera_emotions, histogram = [], [], [], [], []
+    bins = np.arange(0, 110, 10)
+    total_rows = 0
+    
+    for chunk in iter_log_chunks(path, chunksize):
+        total_rows += len(chunk)
+        hourly.append(chunk.groupby(["hour", "emotion"], observed=True).size())
+        daily.append(chunk.groupby("date").agg(
+            satisfaction_sum=("satisfaction_level", "sum"),
+            confidence_sum=("confidence", "sum"),
+            records=("emotion", "size")
+        ))
+        cameras.append(chunk.groupby("camera_method", observed=True).agg(
+            records=("emotion", "size"),
+            confidence_sum=("confidence", "sum"),
+            satisfaction_sum=("satisfaction_level", "sum")
+        ))
+        camera_emotions.append(chunk.groupby(["camera_method", "emotion"], observed=True).size())
+        conf_bin = pd.cut(chunk["confidence"].clip(0, 100), bins, include_lowest=True)
+        histogram.append(chunk.groupby([conf_bin, "emotion"], observed=True).size())
+    
+    if total_rows == 0:
+        return {}
+    
+    def combine(parts):
+        return pd.concat(parts).groupby(level=list(range(parts[0].index.nlevels))).sum()
+    
+    hourly_counts = combine(hourly).unstack(fill_value=0)
+    emotion_share = hourly_counts.div(hourly_counts.sum(axis=1), axis=0).mul(100).round(2)
+    
+    daily_totals = combine(daily)
+    satisfaction_trend = pd.DataFrame({
+        "records": daily_totals["records"],
+        "avg_satisfaction": (daily_totals["satisfaction_sum"] / daily_totals["records"]).round(3),
+        "avg_confidence": (daily_totals["confidence_sum"] / daily_totals["records"]).round(2),
+    })
+    # หน้าต่าง 7 วันตามปฏิทิน (วันที่ไม่มีข้อมูลไม่ใช่แถว) ถ่วงน้ำหนักตามจำนวนเรคอร์ด
+    dates = pd.to_datetime(daily_totals.index, errors="coerce")
+    daily_sums = daily_totals[["satisfaction_sum", "records"]].set_axis(dates)
+    daily_sums = daily_sums[daily_sums.index.notna()].groupby(level=0).sum().sort_index()
+    window = daily_sums.rolling("7D").sum()
+    satisfaction_7d = (window["satisfaction_sum"] / window["records"]).round(3)
+    satisfaction_trend["satisfaction_7d"] = satisfaction_7d.reindex(dates).to_numpy()
+    
+    camera_totals = combine(cameras)
+    camera_counts = combine(camera_emotions).unstack(fill_value=0)
+    per_camera = pd.DataFrame({
+        "records": camera_totals["records"],
+        "avg_confidence": (camera_totals["confidence_sum"] / camera_totals["records"]).round(2),
+        "avg_satisfaction": (camera_totals["satisfaction_sum"] / camera_totals["records"]).round(3),
+        "dominant_emotion": camera_counts.idxmax(axis=1),
+    }).join(camera_counts.div(camera_counts.sum(axis=1), axis=0).mul(100).round(2).add_suffix(" %"))
+    
+    confidence_distribution = combine(histogram).unstack(fill_value=0)
+    confidence_distribution.index = confidence_distribution.index.astype(str)
+    
+    return {
+        "Emotion share by hour": emotion_share,
+        "Satisfaction trend": satisfaction_trend,
+        "Per camera": per_camera,
+        "Confidence distribution": confidence_distribution,
+    }
+
+def write_emotion_report(summary, output):
+    """เขียนรายงานเป็น Excel (หลายชีทพร้อมจัดรูปแบบ) หรือ CSV (หนึ่งไฟล์ต่อตาราง)"""
+    if output.lower().endswith(".csv"):
+        base = output[:-4]
+        paths = []
+        for name, table in summary.items():
+            path = f"{base}_{name.lower().replace(' ', '_')}.csv"
+            table.to_csv(path)
+            paths.append(path)
+        return paths
+    
+    header_font = Font(bold=True, size=12)
+    header_fill = PatternFill(start_color="CCE5FF", end_color="CCE5FF", fill_type="solid")
+    
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        for name, table in summary.items():
+            table.to_excel(writer, sheet_name=name[:31])
+            ws = writer.sheets[name[:31]]
+            for cell in ws[1]:
+                cell.font = header_font
+                cell.fill = header_fill
+                cell.alignment = Alignment(horizontal='center')
+            for column in ws.columns:
+                ws.column_dimensions[column[0].column_letter].width = 15
+            ws.freeze_panes = "B2"
+    return [output]
+
+def run_report(log_path, output):
+    """สร้างรายงานสรุปจาก log การตรวจจับ"""
+    if not os.path.exists(log_path):
+        print(f"❌ Log file not found: {log_path}")
+        return False
+    
+    print(f"📊 Building report from {log_path}...")
+    start = time.time()
+    summary = summarize_emotion_log(log_path)
+    if not summary:
+        print("⚠️ Log contains no records")
+        return False
+    
+    paths = write_emotion_report(summary, output)
+    print(f"✅ Report written in {time.time() - start:.1f}s: {', '.join(paths)}")
+    return True
+
+class CaptureSupervisor:
+    """เฝ้าดูเธรดจับภาพ ตรวจจับกล้องค้าง ภาพนิ่ง และข้อผิดพลาดจากเวลา/ลำดับเฟรม
+    แล้วเชื่อมต่อใหม่แบบ backoff หรือสลับไป backend อื่น โดยลูปหลักยังทำงานต่อได้
+
+    ภาพนิ่งตัดสินจาก timestamp ของเฟรมจากไดรเวอร์ (SensorTimestamp / CAP_PROP_POS_MSEC)
+    ที่ไม่เดินต่อ ฉากที่นิ่งจริงจึงไม่ถูกนับ ใช้ลายเซ็นพิกเซลเฉพาะแหล่งภาพที่ไม่มี timestamp
+    """
+
+    def __init__(self, detector, stall_timeout=CAPTURE_STALL_TIMEOUT,
+                 frozen_timeout=CAPTURE_FROZEN_TIMEOUT, max_errors=CAPTURE_MAX_ERRORS,
+                 backoff_initial=CAPTURE_BACKOFF_INITIAL, backoff_max=CAPTURE_BACKOFF_MAX,
+                 failover_after=CAPTURE_FAILOVER_AFTER, check_interval=0.2):
+        self.detector = detector
+        self.stall_timeout = stall_timeout
+        self.frozen_timeout = frozen_timeout
+        self.max_errors = max_errors
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.failover_after = failover_after
+        self.check_interval = check_interval
+        
+        self.state = "idle"
+        self.frames = 0
+        self.last_frame_time = 0.0
+        self.consecutive_errors = 0
+        self.errors = 0
+        self.stalls = 0
+        self.frozen_events = 0
+        self.reconnects = 0
+        self.failovers = 0
+        self.downtime = 0.0
+        self.last_outage = 0.0
+        self._outage_start = None
+        self._signature = None
+        self._frozen_since = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """เริ่มเธรดเฝ้าดู (เรียกหลังตั้งค่ากล้องสำเร็จ)"""
+        with self._lock:
+            self.state = "running"
+            self.last_frame_time = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=CAMERA_DISCOVERY_TIMEOUT + 1)
+        self.state = "stopped"
+
+    def note_frame(self, frame, timestamp=None):
+        """เรียกจากเธรดจับภาพทุกครั้งที่ได้เฟรมใหม่ (timestamp จากไดรเวอร์ ถ้ามี)"""
+        now = time.time()
+        if timestamp is None:
+            # ไม่มี timestamp: ใช้ลายเซ็นจากพิกเซลที่สุ่มเป็นตาราง ถูกกว่าการเทียบทั้งภาพมาก
+            signature = ("pixels", hash(frame[::16, ::16].tobytes()))
+        else:
+            signature = ("timestamp", timestamp)
+        with self._lock:
+            self.frames += 1
+            self.last_frame_time = now
+            self.consecutive_errors = 0
+            if signature == self._signature:
+                if self._frozen_since is None:
+                    self._frozen_since = now
+            else:
+                self._signature = signature
+                self._frozen_since = None
+
+    def note_error(self, error):
+        """เรียกจากเธรดจับภาพเมื่ออ่านเฟรมไม่สำเร็จ"""
+        with self._lock:
+            self.errors += 1
+            self.consecutive_errors += 1
+
+    def check(self, now=None):
+        """คืนค่าสาเหตุที่ต้องเชื่อมต่อใหม่ หรือ None ถ้ากล้องปกติ"""
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.state != "running":
+                return None
+            if self.consecutive_errors >= self.max_errors:
+                return "errors"
+            if now - self.last_frame_time > self.stall_timeout:
+                return "stall"
+            if self._frozen_since is not None and now - self._frozen_since > self.frozen_timeout:
+                return "frozen"
+        thread = getattr(self.detector, "capture_thread", None)
+        if thread is not None and not thread.is_alive() and self.detector.is_running:
+            return "capture thread stopped"
+        return None
+
+    def _watch(self):
+        while not self._stop.wait(self.check_interval):
+            reason = self.check()
+            if reason:
+                self._recover(reason)
+
+    def _recover(self, reason):
+        now = time.time()
+        failed = self.detector.camera_method
+        with self._lock:
+            if reason == "stall":
+                self.stalls += 1
+            elif reason == "frozen":
+                self.frozen_events += 1
+            self.state = "reconnecting"
+            # นับเวลาที่ใช้ไม่ได้ตั้งแต่เฟรมดีล่าสุด ไม่ใช่ตอนที่ตรวจพบ
+            if reason == "frozen" and self._frozen_since is not None:
+                self._outage_start = self._frozen_since
+            else:
+                self._outage_start = min(now, self.last_frame_time)
+        print(f"🩺 Camera {failed} unhealthy ({reason}), reconnecting...")
+        
+        delay = self.backoff_initial
+        attempt = 0
+        found = None
+        while not self._stop.is_set() and self.detector.is_running:
+            attempt += 1
+            # ลอง backend เดิมก่อน แล้วจึงเปิดให้ทุก backend แข่งกัน (failover)
+            names = [failed] if attempt <= self.failover_after else None
+            found = self.detector.reconnect_camera(names)
+            if self._stop.is_set() or not self.detector.is_running:
+                # ถูกสั่งหยุด (cleanup) ระหว่าง probe: ห้ามเปิดกล้องค้างไว้หลัง cleanup
+                if found:
+                    self.detector._stop_capture()
+                return
+            if found:
+                break
+            print(f"   reconnect attempt {attempt} failed, retrying in {delay:.1f}s")
+            self._stop.wait(delay)
+            delay = min(delay * 2, self.backoff_max)
+        
+        if not found:
+            return
+        
+        now = time.time()
+        with self._lock:
+            self.last_outage = now - self._outage_start
+            self.downtime += self.last_outage
+            self._outage_start = None
+            self.consecutive_errors = 0
+            self._signature = None
+            self._frozen_since = None
+            self.last_frame_time = now
+            self.state = "running"
+            if found == failed:
+                self.reconnects += 1
+            else:
+                self.failovers += 1
+        print(f"✅ Camera recovered via {found} after {self.last_outage:.1f}s")
+
+    def metrics(self):
+        """สถิติของการจับภาพ: เวลาที่กล้องใช้ไม่ได้ จำนวนการเชื่อมต่อใหม่ ฯลฯ"""
+        with self._lock:
+            downtime = self.downtime
+            if self._outage_start is not None:
+                downtime += time.time() - self._outage_start
+            return {
+                "state": self.state,
+                "backend": self.detector.camera_method,
+                "frames": self.frames,
+                "errors": self.errors,
+                "stalls": self.stalls,
+                "frozen_events": self.frozen_events,
+                "reconnects": self.reconnects,
+                "failovers": self.failovers,
+                "downtime_s": round(downtime, 2),
+                "last_outage_s": round(self.last_outage, 2),
+            }
+
+class RaspberryPi4CameraDetector:
+    def __init__(self, excel_file="emotion_data.xlsx", log_file="emotion_log.csv"):
         self.cap = None
         self.picam2 = None
         self.camera_method = None
         self.face_cascade = None
-        self.emotion_history = deque(maxlen=100)  # ใช้ deque แทน list
+        self.emotion_history = EmotionHistory()  # ring buffer แบบ NumPy
         self.is_running = False
         self.frame_buffer = None
+        self.lores_buffer = None  # เฟรมความละเอียดต่ำจากสตรีม lores ของ PiCamera2
+        self._frame_lores = None  # lores ของเฟรมล่าสุดที่ get_frame ส่งออกไป
+        self.lores_enabled = False
+        self.simulated_source = None  # ไฟล์วิดีโอ/รูปภาพสำหรับกล้องจำลอง
+        self.remote_client = None  # RemoteEmotionClient เมื่อใช้เซิร์ฟเวอร์วิเคราะห์ในเครือข่าย
+        self.clip_recorder = None
+        self.clips_enabled = True  # บันทึกคลิปอัตโนมัติเมื่อเกิดเหตุการณ์
+        self.clip_max_files = CLIP_MAX_FILES
+        self.clip_max_mb = CLIP_MAX_MB
+        self._face_present = False
         self.buffer_lock = threading.Lock()
+        self.frame_ready = threading.Condition(self.buffer_lock)
+        self.frame_seq = 0  # ลำดับเฟรมล่าสุดจากเธรดจับภาพ
+        self._consumed_seq = 0  # ลำดับเฟรมล่าสุดที่ get_frame ส่งออกไป
+        self._capture_generation = 0  # เปลี่ยนทุกครั้งที่เปิดกล้องใหม่ เพื่อหยุดเธรดเก่า
+        self.capture_thread = None
+        self._capture_owner = None  # สถานะของเธรดจับภาพปัจจุบัน (ออกแล้ว/กล้องถูกทิ้งให้ปิดเอง)
+        self._camera_switch_lock = threading.RLock()  # กันการเปิดกล้องใหม่แทรกระหว่าง cleanup
+        self.capture_supervisor = CaptureSupervisor(self)
+        self.simulated_realtime = True
+        self.fault_injector = None  # FaultInjector สำหรับทดสอบกล้องจำลอง
         self.color_mode = "color"
         self.auto_exposure = True
         self.brightness = 0.0
         self.contrast = 1.0
         self.camera_type = None
-        self.excel_file = "emotion_data.xlsx"
+        self.camera_cache_file = CAMERA_CACHE_FILE
+        self.thread_budget = ThreadBudget()
+        self.camera_discovery_time = 0.0
+        self.excel_file = excel_file
+        self.log_file = log_file  # log แบบ append-only สำหรับรายงานย้อนหลัง
+        self._log_fh = None
+        self._log_writer = None
         
         # เพิ่มตัวแปรสำหรับการปรับแต่งประสิทธิภาพ
         self.frame_count = 0
         self.last_emotion_time = 0
+        self.min_emotion_interval = 0.1  # 100ms ระหว่างการวิเคราะห์แต่ละครั้ง
+        self.analyze_fn = analyze_emotion_local if DEEPFACE_AVAILABLE else None
         self.emotion_cache = {}  # แคชผลการตรวจจับอารมณ์
         self.data_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
-        self.excel_save_counter = 0
+        self.dropped_records = 0
+        self.queued_records = 0
+        self._excel_pending = []  # แถวที่รอเธรด Excel เขียนลง workbook
+        self._excel_lock = threading.Lock()
+        self._excel_write_lock = threading.Lock()  # ถือระหว่างเขียน/save workbook
+        self._excel_next_row = None
+        self._next_excel_save = 0.0
         
-        # เริ่มเธรดสำหรับการบันทึกข้อมูล
-        self.save_thread = threading.Thread(target=self._save_data_worker, daemon=True)
-        self.save_thread.start()
+        self.save_thread = None
+        self.excel_thread = None
         
         self.load_face_cascade()
         self.initialize_excel()
 
+    def start_save_thread(self):
+        """เริ่มเธรดสำหรับการบันทึกข้อมูล (ต้องตั้ง is_running ก่อน)"""
+        if self.save_thread is None or not self.save_thread.is_alive():
+            self.save_thread = threading.Thread(target=self._save_data_worker, daemon=True)
+            self.save_thread.start()
+        if self.excel_thread is None or not self.excel_thread.is_alive():
+            self.excel_thread = threading.Thread(target=self._excel_writer_worker, daemon=True)
+            self.excel_thread.start()
+
     def _save_data_worker(self):
-        """เธรดสำหรับการบันทึกข้อมูลลง Excel"""
+        """เธรดสำหรับการบันทึกข้อมูล: เขียน CSV log ทันทีแล้วส่งแถวต่อให้เธรด Excel"""
+        self.thread_budget.pin("persistence")
         while self.is_running:
             try:
                 data = self.data_queue.get(timeout=1)
                 if data:
-                    self._save_to_excel_internal(*data)
-                    self.excel_save_counter += 1
-                    
-                    # บันทึกไฟล์ Excel ทุกๆ EXCEL_SAVE_INTERVAL ครั้ง
-                    if self.excel_save_counter >= EXCEL_SAVE_INTERVAL:
-                        self._save_excel_file()
-                        self.excel_save_counter = 0
+                    self._append_log_row(data)
+                    with self._excel_lock:
+                        self._excel_pending.append(data)
             except queue.Empty:
                 continue
             except Exception as e:
                 print(f"❌ เกิดข้อผิดพลาดในการบันทึกข้อมูล: {e}")
 
+    def _excel_writer_worker(self):
+        """เธรดเขียน workbook แยกจากคิวบันทึก
+
+        การ save ทั้งไฟล์ช้าลงตามขนาด workbook ถ้าทำในเธรดเดียวกับคิว
+        คิวจะเต็มและทิ้งข้อมูลทุกครั้งที่ save เมื่อรันไปหลายชั่วโมง
+        """
+        self.thread_budget.pin("persistence")
+        while self.is_running:
+            time.sleep(0.2)
+            with self._excel_lock:
+                pending = len(self._excel_pending)
+            # บันทึกไฟล์ Excel ทุกๆ EXCEL_SAVE_INTERVAL ครั้ง แต่เว้นระยะตามเวลาที่ใช้เขียนครั้งก่อน
+            if pending >= EXCEL_SAVE_INTERVAL and time.time() >= self._next_excel_save:
+                self._flush_excel()
+
+    def _flush_excel(self):
+        """เขียนแถวที่ค้างอยู่ลง workbook แล้วบันทึกไฟล์
+
+        ถือ _excel_write_lock ตลอดการเขียนและ save เพราะ cleanup อาจเรียกซ้อนกับเธรด Excel
+        ที่ยัง save workbook ขนาดใหญ่ไม่เสร็จ (เขียนพร้อมกันทำให้ไฟล์เสีย)
+        """
+        with self._excel_write_lock:
+            with self._excel_lock:
+                rows, self._excel_pending = self._excel_pending, []
+            if not rows:
+                return
+            for data in rows:
+                self._save_to_excel_internal(*data)
+            started = time.time()
+            self._save_excel_file()
+            elapsed = time.time() - started
+            self._next_excel_save = time.time() + max(EXCEL_MIN_SAVE_SECONDS, elapsed / EXCEL_MAX_SAVE_DUTY)
+
     def _save_excel_file(self):
         """บันทึกไฟล์ Excel"""
         try:
             if hasattr(self, '_wb'):
                 self._wb.save(self.excel_file)
+            if self._log_fh:
+                self._log_fh.flush()
         except Exception as e:
             print(f"❌ เกิดข้อผิดพลาดในการบันทึกไฟล์ Excel: {e}")
 
+    def _append_log_row(self, data):
+        """เพิ่มแถวลงใน CSV log (เปิดไฟล์ค้างไว้เพื่อไม่ต้องเปิดใหม่ทุกแถว)"""
+        try:
+            if self._log_fh is None:
+                is_new = not os.path.exists(self.log_file)
+                self._log_fh = open(self.log_file, "a", newline="", encoding="utf-8")
+                self._log_writer = csv.writer(self._log_fh)
+                if is_new:
+                    self._log_writer.writerow(LOG_COLUMNS)
+            self._log_writer.writerow(data)
+        except Exception as e:
+            print(f"❌ เกิดข้อผิดพลาดในการบันทึก CSV log: {e}")
+
     def initialize_excel(self):
         """สร้างไฟล์ Excel ใหม่ถ้ายังไม่มี"""
         try:
@@ -141,8 +1436,11 @@ class RaspberryPi4CameraDetector:
                 self.camera_method
             )
             self.data_queue.put(data, block=False)
+            self.queued_records += 1
         except queue.Full:
-            print("⚠️ คิวข้อมูลเต็ม กำลังข้ามการบันทึกข้อมูล")
+            self.dropped_records += 1
+            if self.dropped_records % 100 == 1:
+                print(f"⚠️ คิวข้อมูลเต็ม กำลังข้ามการบันทึกข้อมูล (ทิ้งแล้ว {self.dropped_records} รายการ)")
 
     def _save_to_excel_internal(self, date, time, emotion, confidence, satisfaction_level, satisfaction_text, camera_method):
         """บันทึกข้อมูลลงในไฟล์ Excel"""
@@ -150,14 +1448,18 @@ class RaspberryPi4CameraDetector:
             if not hasattr(self, '_wb'):
                 self._wb = openpyxl.load_workbook(self.excel_file)
             ws = self._wb.active
+            # ws.max_row ไล่ดูทุกเซลล์ (O(n) ต่อแถว) จึงนับแถวเองหลังเปิด workbook ครั้งแรก
+            if self._excel_next_row is None:
+                self._excel_next_row = ws.max_row + 1
             
-            next_row = ws.max_row + 1
+            next_row = self._excel_next_row
+            self._excel_next_row += 1
             data = [date, time, emotion, confidence, satisfaction_level, satisfaction_text, camera_method]
             
             for col, value in enumerate(data, 1):
                 cell = ws.cell(row=next_row, column=col)
                 cell.value = value
-                cell.alignment = Alignment(horizontal='center')
+                cell.alignment = CENTER_ALIGNMENT
             
         except Exception as e:
             print(f"❌ เกิดข้อผิดพลาดในการบันทึกข้อมูลลง Excel: {e}")
@@ -234,29 +1536,33 @@ class RaspberryPi4CameraDetector:
         
         print("=" * 50)
     
-    def setup_picamera2(self):
-        """ตั้งค่า PiCamera2 สำหรับ Raspberry Pi 4 พร้อมจัดการสี"""
+    def _open_picamera2(self):
+        """เปิด PiCamera2 และทดสอบจับภาพ คืนค่า Picamera2 หรือ None"""
+        if not PICAMERA2_AVAILABLE:
+            return None
+        
+        picam2 = Picamera2()
         try:
-            if not PICAMERA2_AVAILABLE:
-                return False
-            
-            print("🔄 Trying PiCamera2 method...")
-            
-            self.picam2 = Picamera2()
-            
             # กำหนดค่า preview config สำหรับสีที่ถูกต้อง
-            if self.color_mode == "grayscale":
-                config = self.picam2.create_preview_configuration(
-                    main={"size": (640, 480), "format": "YUV420"},
+            main_format = "YUV420" if self.color_mode == "grayscale" else "RGB888"
+            
+            # สตรีมที่สอง (lores) สำหรับการวิเคราะห์ ลดภาระการย่อภาพบน CPU
+            try:
+                config = picam2.create_preview_configuration(
+                    main={"size": DISPLAY_SIZE, "format": main_format},
+                    lores={"size": ANALYSIS_SIZE, "format": "YUV420"},
                     controls={"FrameRate": 30}
                 )
-            else:
-                config = self.picam2.create_preview_configuration(
-                    main={"size": (640, 480), "format": "RGB888"},
+                picam2.configure(config)
+                self.lores_enabled = True
+            except Exception as e:
+                print(f"⚠️ Lores stream not available, using software downscale: {e}")
+                config = picam2.create_preview_configuration(
+                    main={"size": DISPLAY_SIZE, "format": main_format},
                     controls={"FrameRate": 30}
                 )
-            
-            self.picam2.configure(config)
+                picam2.configure(config)
+                self.lores_enabled = False
             
             # ตั้งค่า controls สำหรับการปรับแสงและสี
             control_settings = {
@@ -269,170 +1575,409 @@ class RaspberryPi4CameraDetector:
                 "Sharpness": 1.0
             }
             
-            self.picam2.set_controls(control_settings)
+            picam2.set_controls(control_settings)
+            picam2.start()
             
-            self.picam2.start()
-            time.sleep(2)  # รอให้กล้องเริ่มต้นและปรับแสง
-            
-            # ทดสอบการจับภาพ
-            frame = self.picam2.capture_array()
+            # capture_array รอเฟรมแรกเอง ไม่ต้อง sleep; AE/AWB ปรับต่อระหว่างทำงาน
+            frame = picam2.capture_array()
             if frame is not None and frame.size > 0:
-                print(f"✅ PiCamera2 method successful - Format: {frame.shape}")
-                print(f"📷 Color mode: {self.color_mode}")
-                self.camera_method = "picamera2"
-                self.start_frame_capture_thread()
-                return True
+                return picam2
+        except Exception:
+            self._release_camera_handle(picam2)
+            raise
+        
+        self._release_camera_handle(picam2)
+        return None
+    
+    def _open_gstreamer(self):
+        """เปิดกล้องผ่าน GStreamer (libcamerasrc)"""
+        if self.color_mode == "grayscale":
+            gst_pipeline = (
+                "libcamerasrc ! "
+                "video/x-raw,width=640,height=480,framerate=30/1,format=GRAY8 ! "
+                "videoconvert ! appsink"
+            )
+        else:
+            gst_pipeline = (
+                "libcamerasrc ! "
+                "video/x-raw,width=640,height=480,framerate=30/1 ! "
+                "videoconvert ! appsink"
+            )
+        
+        return self._read_test_frame(cv2.VideoCapture(gst_pipeline, cv2.CAP_GSTREAMER))
+    
+    def _open_v4l2(self):
+        """เปิดกล้องผ่าน V4L2 โดยตรง"""
+        # เปิดใช้งาน bcm2835-v4l2 module เฉพาะเมื่อยังไม่มี /dev/video0
+        if not os.path.exists("/dev/video0"):
+            try:
+                subprocess.run(["sudo", "-n", "modprobe", "bcm2835-v4l2"],
+                               capture_output=True, timeout=2)
+            except (subprocess.TimeoutExpired, FileNotFoundError):
+                return None
+            deadline = time.time() + 2
+            while not os.path.exists("/dev/video0") and time.time() < deadline:
+                time.sleep(0.05)
+        
+        cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+        if cap.isOpened():
+            # ตั้งค่าความละเอียดและ FPS
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            cap.set(cv2.CAP_PROP_FPS, 30)
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            
+            # ตั้งค่าสี
+            cap.set(cv2.CAP_PROP_BRIGHTNESS, 0.5)
+            cap.set(cv2.CAP_PROP_CONTRAST, 0.5)
+            cap.set(cv2.CAP_PROP_SATURATION, 0.5)
+            cap.set(cv2.CAP_PROP_AUTO_WB, 1.0)
+        return self._read_test_frame(cap)
+    
+    def _open_usb(self, index):
+        """เปิดกล้อง USB/เว็บแคมตาม index"""
+        cap = cv2.VideoCapture(index)
+        if cap.isOpened():
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            cap.set(cv2.CAP_PROP_FPS, 30)
+        return self._read_test_frame(cap)
+    
+    def _read_test_frame(self, cap):
+        """ทดสอบอ่านเฟรมแรก คืนค่า cap ถ้าใช้งานได้ ไม่เช่นนั้นปล่อยและคืน None"""
+        if cap.isOpened():
+            ret, frame = cap.read()
+            if ret and frame is not None:
+                return cap
+        cap.release()
+        return None
+    
+    def _release_camera_handle(self, handle):
+        """ปิดกล้องที่เปิดจากการ probe (VideoCapture หรือ Picamera2)"""
+        try:
+            if hasattr(handle, "release"):
+                handle.release()
             else:
-                self.picam2.stop()
-                return False
-                
-        except Exception as e:
-            print(f"   PiCamera2 error: {e}")
-            if self.picam2:
-                try:
-                    self.picam2.stop()
-                except:
-                    pass
-            return False
+                handle.stop()
+                handle.close()
+        except Exception:
+            pass
     
-    def start_frame_capture_thread(self):
-        """เริ่มเธรดสำหรับจับภาพอย่างต่อเนื่อง"""
-        def capture_frames():
-            while self.is_running:
+    def camera_candidates(self):
+        """รายการ backend ที่จะ probe แบ่งเป็นกลุ่ม
+
+        กลุ่มต่างกันถูก probe พร้อมกัน ส่วน backend ในกลุ่มเดียวกันใช้อุปกรณ์เดียวกัน
+        (libcamera หรือ /dev/video0) จึงต้อง probe ทีละตัวตามลำดับ
+        """
+        if self.camera_type == "laptop":
+            return [[("laptop_webcam", lambda: self._open_usb(0))]]
+        if self.camera_type == "simulated":
+            return [[("simulated", lambda: self._read_test_frame(SimulatedCamera(
+                self.simulated_source, realtime=self.simulated_realtime, faults=self.fault_injector
+            )))]]
+        
+        libcamera_group = [("gstreamer", self._open_gstreamer)]
+        if PICAMERA2_AVAILABLE:
+            libcamera_group.insert(0, ("picamera2", self._open_picamera2))
+        groups = [libcamera_group, [("v4l2", self._open_v4l2), ("usb_0", lambda: self._open_usb(0))]]
+        for i in range(1, 4):
+            groups.append([(f"usb_{i}", lambda i=i: self._open_usb(i))])
+        return groups
+    
+    def _run_probes(self, groups, timeout=CAMERA_DISCOVERY_TIMEOUT):
+        """probe กลุ่ม backend พร้อมกัน คืนค่า (ชื่อ, handle) ที่ใช้ได้ตามลำดับความสำคัญ หรือ None
+
+        กลุ่มที่อยู่ก่อนมีความสำคัญสูงกว่า เมื่อกลุ่มหลังเปิดได้ก่อนจะรอกลุ่มก่อนหน้า
+        ให้เสร็จอีกไม่เกิน CAMERA_PRIORITY_GRACE วินาที แล้วจึงเลือกตัวที่ดีที่สุดที่มี
+        """
+        results = [None] * len(groups)
+        done = [False] * len(groups)
+        state = {"closed": False}
+        cond = threading.Condition()
+        
+        def beaten(index):
+            return any(results[:index])
+        
+        def probe_group(index, group):
+            for name, probe in group:
+                with cond:
+                    if beaten(index) or state["closed"]:
+                        break
                 try:
-                    if self.picam2:
-                        frame = self.picam2.capture_array()
-                        with self.buffer_lock:
-                            self.frame_buffer = frame.copy()
-                    time.sleep(0.03)  # ~30 FPS
+                    handle = probe()
                 except Exception as e:
-                    print(f"Frame capture error: {e}")
+                    print(f"   {name} probe error: {e}")
+                    handle = None
+                if handle is None:
+                    continue
+                with cond:
+                    accepted = not beaten(index) and not state["closed"]
+                    if accepted:
+                        results[index] = (name, handle)
+                if not accepted:
+                    # กลุ่มที่สำคัญกว่าเปิดได้แล้ว หรือหมดเวลา: ปิดกล้องที่เปิดไว้
+                    self._release_camera_handle(handle)
+                break
+            with cond:
+                done[index] = True
+                cond.notify_all()
+        
+        def decided():
+            # ตัดสินได้เมื่อทุกกลุ่มก่อนหน้ากลุ่มที่สำเร็จตัวแรกเสร็จหมดแล้ว
+            for index, result in enumerate(results):
+                if result:
+                    return True
+                if not done[index]:
+                    return False
+            return True
+        
+        for index, group in enumerate(groups):
+            threading.Thread(target=probe_group, args=(index, group), daemon=True).start()
+        
+        deadline = time.time() + timeout
+        grace_started = False
+        with cond:
+            while not decided():
+                if any(results) and not grace_started:
+                    deadline = min(deadline, time.time() + CAMERA_PRIORITY_GRACE)
+                    grace_started = True
+                remaining = deadline - time.time()
+                if remaining <= 0:
                     break
+                cond.wait(remaining)
+            state["closed"] = True
+            found = [result for result in results if result]
         
-        self.is_running = True
-        self.capture_thread = threading.Thread(target=capture_frames, daemon=True)
-        self.capture_thread.start()
+        for name, handle in found[1:]:
+            self._release_camera_handle(handle)
+        return found[0] if found else None
+    
+    def _adopt_camera(self, name, handle, reconnect=False):
+        """ใช้ handle ที่ probe สำเร็จเป็นกล้องหลักและเริ่มเธรดจับภาพ"""
+        self.camera_method = name
+        if name == "picamera2":
+            self.picam2 = handle
+            print(f"📷 Color mode: {self.color_mode}")
+            print(f"🔬 Analysis stream: {ANALYSIS_SIZE[0]}x{ANALYSIS_SIZE[1]} "
+                  f"({'lores' if self.lores_enabled else 'software downscale'})")
+        else:
+            self.cap = handle
+        self.start_frame_capture_thread(reconnect)
+    
+    def _stop_capture(self):
+        """หยุดเธรดจับภาพปัจจุบันและปิดกล้อง
+
+        ปิดกล้องหลังเธรดเดิมออกจาก read() แล้วเท่านั้น (OpenCV ไม่รองรับ release ระหว่าง read)
+        ถ้า read ยังค้าง เธรดนั้นจะปิดกล้องเองเมื่อ read คืนค่า
+        """
+        with self._camera_switch_lock:
+            with self.buffer_lock:
+                self._capture_generation += 1
+                self.frame_buffer = None
+                self.lores_buffer = None
+                self.frame_ready.notify_all()
+            handle = self.picam2 or self.cap
+            self.picam2 = None
+            self.cap = None
+            thread, owner = self.capture_thread, self._capture_owner
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(timeout=CAPTURE_JOIN_TIMEOUT)
+            if handle is None:
+                return
+            with self.buffer_lock:
+                # เธรดที่ยังไม่ออกจะเห็น abandoned ตอนออกและปิดกล้องเอง
+                abandoned = owner is not None and not owner["exited"]
+                if abandoned:
+                    owner["abandoned"] = True
+            if not abandoned:
+                self._release_camera_handle(handle)
     
-    def setup_opencv_camera(self):
-        """ตั้งค่ากล้องด้วย OpenCV สำหรับ Raspberry Pi 4 พร้อมจัดการสี"""
+    def reconnect_camera(self, names=None):
+        """ปิดกล้องเดิมแล้วเปิดใหม่ เฉพาะ backend ใน names หรือทุก backend ถ้าเป็น None
+
+        คืนค่าชื่อ backend ที่เชื่อมต่อได้ หรือ None
+        """
+        self._stop_capture()
+        groups = self.camera_candidates()
+        if names:
+            groups = [[(name, probe) for name, probe in group if name in names] for group in groups]
+            groups = [group for group in groups if group]
+        found = self._run_probes(groups)
+        if found is None:
+            return None
+        with self._camera_switch_lock:
+            if not self.is_running:
+                # cleanup เริ่มแล้วระหว่าง probe: ปิดกล้องที่เพิ่งเปิดแทนการเริ่มจับภาพใหม่
+                self._release_camera_handle(found[1])
+                return None
+            self._adopt_camera(*found, reconnect=True)
+        return found[0]
+    
+    def load_camera_cache(self):
+        """อ่าน backend และค่าตั้งล่าสุดที่ใช้งานได้ (เฉพาะประเภทกล้องเดียวกัน)"""
         try:
-            print("🔄 Trying OpenCV with V4L2...")
-            
-            # ลองใช้ GStreamer pipeline ก่อน
-            if self.color_mode == "grayscale":
-                gst_pipeline = (
-                    "libcamerasrc ! "
-                    "video/x-raw,width=640,height=480,framerate=30/1,format=GRAY8 ! "
-                    "videoconvert ! appsink"
-                )
-            else:
-                gst_pipeline = (
-                    "libcamerasrc ! "
-                    "video/x-raw,width=640,height=480,framerate=30/1 ! "
-                    "videoconvert ! appsink"
-                )
-            
-            self.cap = cv2.VideoCapture(gst_pipeline, cv2.CAP_GSTREAMER)
-            
-            if self.cap.isOpened():
-                ret, frame = self.cap.read()
-                if ret and frame is not None:
-                    print(f"✅ GStreamer pipeline successful - Shape: {frame.shape}")
-                    self.camera_method = "gstreamer"
-                    return True
-                self.cap.release()
-            
-            # ถ้า GStreamer ไม่ได้ ลอง V4L2
-            print("🔄 Trying V4L2 direct access...")
-            
-            # เปิดใช้งาน bcm2835-v4l2 module
-            os.system("sudo modprobe bcm2835-v4l2 2>/dev/null")
-            time.sleep(2)
-            
-            self.cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
-            
-            if self.cap.isOpened():
-                # ตั้งค่าความละเอียดและ FPS
-                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-                self.cap.set(cv2.CAP_PROP_FPS, 30)
-                self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-                
-                # ตั้งค่าสี
-                self.cap.set(cv2.CAP_PROP_BRIGHTNESS, 0.5)
-                self.cap.set(cv2.CAP_PROP_CONTRAST, 0.5)
-                self.cap.set(cv2.CAP_PROP_SATURATION, 0.5)
-                self.cap.set(cv2.CAP_PROP_AUTO_WB, 1.0)
-                
-                ret, frame = self.cap.read()
-                if ret and frame is not None:
-                    print(f"✅ V4L2 method successful - Shape: {frame.shape}")
-                    self.camera_method = "v4l2"
-                    return True
-                self.cap.release()
-            
-            # ลองกล้อง USB
-            print("🔄 Trying USB cameras...")
-            for i in range(4):
-                self.cap = cv2.VideoCapture(i)
-                if self.cap.isOpened():
-                    self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                    self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-                    ret, frame = self.cap.read()
-                    if ret and frame is not None:
-                        print(f"✅ USB camera found at index {i} - Shape: {frame.shape}")
-                        self.camera_method = f"usb_{i}"
-                        return True
-                    self.cap.release()
-            
-            return False
-            
-        except Exception as e:
-            print(f"   OpenCV camera error: {e}")
-            if self.cap:
-                self.cap.release()
-            return False
+            with open(self.camera_cache_file, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cache.get("camera_type") != self.camera_type:
+            return None
+        return cache
     
-    def setup_laptop_camera(self):
-        """ตั้งค่ากล้องโน๊ตบุ๊ค"""
+    def save_camera_cache(self):
+        """บันทึก backend และค่าตั้งปัจจุบันเป็น last-known-good"""
+        if not self.camera_method:
+            return
+        cache = {
+            "camera_type": self.camera_type,
+            "method": self.camera_method,
+            "brightness": self.brightness,
+            "contrast": self.contrast,
+            "auto_exposure": self.auto_exposure,
+            "discovery_s": round(self.camera_discovery_time, 3),
+            "updated": datetime.now().isoformat(timespec="seconds"),
+        }
         try:
-            print("🔄 กำลังตั้งค่ากล้องเว็บแคม...")
-            self.cap = cv2.VideoCapture(0)  # ใช้กล้องแรกที่เจอ
-            
-            if self.cap.isOpened():
-                # ตั้งค่าความละเอียดและ FPS
-                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-                self.cap.set(cv2.CAP_PROP_FPS, 30)
-                
-                ret, frame = self.cap.read()
-                if ret and frame is not None:
-                    print(f"✅ ตั้งค่ากล้องเว็บแคมสำเร็จ - ขนาดภาพ: {frame.shape}")
-                    self.camera_method = "laptop_webcam"
-                    return True
-                self.cap.release()
-            
+            with open(self.camera_cache_file, "w", encoding="utf-8") as f:
+                json.dump(cache, f, indent=2)
+        except OSError as e:
+            print(f"⚠️ Cannot write camera cache: {e}")
+    
+    def discover_camera(self):
+        """ค้นหากล้อง: ลอง backend ที่แคชไว้ก่อน ถ้าไม่ได้จึง probe ทุก backend พร้อมกัน"""
+        start = time.time()
+        groups = self.camera_candidates()
+        probes = {name: probe for group in groups for name, probe in group}
+        
+        found = None
+        source = "probed"
+        cache = self.load_camera_cache()
+        if cache and cache.get("method") in probes:
+            self.brightness = cache.get("brightness", self.brightness)
+            self.contrast = cache.get("contrast", self.contrast)
+            self.auto_exposure = cache.get("auto_exposure", self.auto_exposure)
+            print(f"⚡ Trying last-known-good camera: {cache['method']}")
+            found = self._run_probes([[(cache["method"], probes[cache["method"]])]])
+            source = "cached"
+            if found is None:
+                print("⚠️ Cached camera unavailable, running full discovery")
+        
+        if found is None:
+            print(f"🔄 Probing {len(probes)} camera backends concurrently...")
+            found = self._run_probes(groups)
+            source = "probed"
+        
+        self.camera_discovery_time = time.time() - start
+        if found is None:
+            print(f"⏱️ Camera discovery failed after {self.camera_discovery_time:.2f}s")
             return False
-            
-        except Exception as e:
-            print(f"❌ เกิดข้อผิดพลาดในการตั้งค่ากล้องเว็บแคม: {e}")
-            if self.cap:
-                self.cap.release()
+        
+        name, handle = found
+        print(f"✅ Camera backend: {name}")
+        print(f"⏱️ Camera discovery: {self.camera_discovery_time:.2f}s ({source})")
+        self._adopt_camera(name, handle)
+        self.save_camera_cache()
+        return True
+    
+    def start_frame_capture_thread(self, reconnect=False):
+        """เริ่มเธรดสำหรับจับภาพอย่างต่อเนื่อง (ทุก backend) ลูปหลักจึงไม่ค้างที่ cap.read()
+
+        reconnect=True (จาก supervisor) ไม่ตั้ง is_running เพื่อไม่ให้ฟื้นระบบที่ถูกสั่งหยุดแล้ว
+        """
+        owner = {"exited": False, "abandoned": False}
+        with self.buffer_lock:
+            self._capture_generation += 1
+            generation = self._capture_generation
+            self._capture_owner = owner
+        picam2, cap = self.picam2, self.cap
+        lockstep = getattr(cap, "lockstep", False)
+        
+        def current():
+            return self.is_running and generation == self._capture_generation
+        
+        def capture_frames():
+            try:
+                capture_loop()
+            finally:
+                with self.buffer_lock:
+                    owner["exited"] = True
+                    abandoned = owner["abandoned"]
+                if abandoned:
+                    self._release_camera_handle(picam2 or cap)
+        
+        def capture_loop():
+            self.thread_budget.pin("capture")
+            last_error_log = 0.0
+            while current():
+                try:
+                    if picam2 is not None:
+                        if self.lores_enabled:
+                            (frame, lores), metadata = picam2.capture_arrays(["main", "lores"])
+                        else:
+                            (frame,), metadata = picam2.capture_arrays(["main"])
+                            lores = None
+                        timestamp = metadata.get("SensorTimestamp")
+                    else:
+                        ret, frame = cap.read()
+                        lores = None
+                        if not ret or frame is None:
+                            raise RuntimeError("camera returned no frame")
+                        # 0 แปลว่า backend ไม่รายงานเวลาเฟรม ให้ supervisor ใช้ลายเซ็นพิกเซลแทน
+                        timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) or None
+                except Exception as e:
+                    if not current():
+                        break
+                    # ไม่หยุดเธรด ให้ supervisor ตัดสินใจเชื่อมต่อใหม่
+                    self.capture_supervisor.note_error(e)
+                    if time.time() - last_error_log >= 2.0:
+                        print(f"Frame capture error: {e}")
+                        last_error_log = time.time()
+                    time.sleep(0.05)
+                    continue
+                
+                with self.frame_ready:
+                    if generation != self._capture_generation:
+                        break
+                    self.frame_buffer = frame.copy()
+                    self.lores_buffer = lores.copy() if lores is not None else None
+                    self.frame_seq += 1
+                    self.frame_ready.notify_all()
+                self.capture_supervisor.note_frame(frame, timestamp)
+                
+                if picam2 is not None:
+                    time.sleep(0.03)  # ~30 FPS
+                elif lockstep:
+                    # แหล่งภาพไม่จำกัดความเร็ว: รอให้เฟรมนี้ถูกใช้ก่อนอ่านเฟรมถัดไป
+                    with self.frame_ready:
+                        self.frame_ready.wait_for(
+                            lambda: self._consumed_seq >= self.frame_seq or not current(),
+                            timeout=0.5
+                        )
+        
+        if not reconnect:
+            self.is_running = True
+        self.capture_thread = threading.Thread(target=capture_frames, daemon=True)
+        self.capture_thread.start()
+    
+    def setup_simulated_camera(self):
+        """ตั้งค่ากล้องจำลองสำหรับทดสอบบนเครื่องที่ไม่มีฮาร์ดแวร์กล้อง"""
+        print("🔄 Setting up simulated camera...")
+        found = self._run_probes(self.camera_candidates())
+        if found is None:
             return False
+        
+        print("✅ Simulated camera ready")
+        self._adopt_camera(*found)
+        return True
     
     def setup_camera(self):
         """ตั้งค่ากล้องตามประเภทที่เลือก"""
         print("🔍 Camera setup...")
         
-        if self.camera_type == "laptop":
-            return self.setup_laptop_camera()
-        elif self.camera_type == "pi":
-            # ลอง PiCamera2 ก่อน (แนะนำสำหรับ RPi 4)
-            if self.setup_picamera2():
-                return True
-            
-            # ถ้าไม่ได้ ลอง OpenCV
-            if self.setup_opencv_camera():
+        if self.camera_type == "simulated":
+            return self.setup_simulated_camera()
+        elif self.camera_type in ("laptop", "pi"):
+            if self.discover_camera():
                 return True
         
         print("❌ No camera found. Troubleshooting steps:")
@@ -441,21 +1986,25 @@ class RaspberryPi4CameraDetector:
         print("   3. Add to /boot/config.txt: camera_auto_detect=1")
         print("   4. Increase GPU memory: gpu_mem=128")
         print("   5. Reboot system")
+        if self.camera_type == "pi":
+            self.check_camera_hardware()
         return False
     
     def get_frame(self):
-        """รับเฟรมจากกล้องและจัดการสี"""
-        frame = None
-        
-        if self.camera_method == "picamera2":
-            with self.buffer_lock:
-                if self.frame_buffer is not None:
-                    frame = self.frame_buffer.copy()
-        elif self.cap and self.cap.isOpened():
-            ret, frame = self.cap.read()
-            if not ret:
-                frame = None
-        
+        """รับเฟรมใหม่จากเธรดจับภาพ (รอไม่เกิน FRAME_WAIT_TIMEOUT) และจัดการสี"""
+        with self.frame_ready:
+            self.frame_ready.wait_for(
+                lambda: self.frame_seq != self._consumed_seq, timeout=FRAME_WAIT_TIMEOUT
+            )
+            if self.frame_seq == self._consumed_seq:
+                return None
+            # เธรดจับภาพสร้าง array ใหม่ทุกเฟรม จึงไม่ต้องคัดลอกซ้ำ
+            # เก็บ lores คู่กับเฟรมนี้ในล็อกเดียวกัน เฟรมวิเคราะห์จึงตรงกับเฟรมแสดงผลเสมอ
+            frame = self.frame_buffer
+            self._frame_lores = self.lores_buffer
+            self._consumed_seq = self.frame_seq
+            self.frame_ready.notify_all()
+
         if frame is None:
             return None
         
@@ -479,69 +2028,87 @@ class RaspberryPi4CameraDetector:
         
         return frame
     
-    def detect_emotion_deepface(self, frame):
-        """ตรวจจับอารมณ์ด้วย DeepFace พร้อมแคชชิ่ง"""
+    def get_analysis_frame(self, frame):
+        """รับเฟรมความละเอียดต่ำสำหรับการวิเคราะห์ (BGR)"""
+        if frame is None:
+            return None
+        
+        if self.camera_method == "picamera2" and self.lores_enabled:
+            lores = self._frame_lores
+            if lores is not None:
+                return lores_to_bgr(lores, ANALYSIS_SIZE, self.color_mode == "grayscale")
+        
+        # แหล่งภาพ OpenCV หรือไม่มี lores: ย่อภาพด้วยซอฟต์แวร์
+        return downscale_frame(frame)
+    
+    def detect_emotion_deepface(self, frame, analysis_frame=None):
+        """ตรวจจับอารมณ์ด้วย DeepFace พร้อมแคชชิ่ง (วิเคราะห์บนเฟรมความละเอียดต่ำถ้ามี)"""
         try:
-            if not DEEPFACE_AVAILABLE:
-                return self.detect_faces_simple(frame)
+            if self.analyze_fn is None and self.remote_client is None:
+                return self.detect_faces_simple(frame, analysis_frame)
             
             # ตรวจสอบแคช
-            frame_hash = hash(frame.tobytes())
+            analysis_input = analysis_frame if analysis_frame is not None else frame
+            frame_hash = hash(analysis_input.tobytes())
             if frame_hash in self.emotion_cache:
                 return self.emotion_cache[frame_hash]
             
             # ข้ามการตรวจจับถ้าเร็วเกินไป
             current_time = time.time()
-            if current_time - self.last_emotion_time < 0.1:  # 100ms
+            if current_time - self.last_emotion_time < self.min_emotion_interval:
                 return None
             
             self.last_emotion_time = current_time
             
-            if self.camera_method == "picamera2":
+            if analysis_frame is not None:
+                # เฟรมวิเคราะห์เป็น BGR อยู่แล้ว
+                frame_bgr = analysis_frame
+            elif self.camera_method == "picamera2":
                 if len(frame.shape) == 3 and frame.shape[2] == 3:
                     frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
                 else:
                     frame_bgr = frame
             else:
                 frame_bgr = frame
-                
-            result = DeepFace.analyze(
-                frame_bgr, 
-                actions=['emotion'], 
-                enforce_detection=False,
-                silent=True
-            )
             
-            if isinstance(result, list) and len(result) > 0:
-                emotion_map = {
-                    'angry': 'Angry',
-                    'disgust': 'Disgust',
-                    'fear': 'Fear',
-                    'happy': 'Happy',
-                    'sad': 'Sad',
-                    'surprise': 'Surprise',
-                    'neutral': 'Neutral'
-                }
-                
-                emotion = result[0]['dominant_emotion']
-                confidence = result[0]['emotion'][emotion]
+            cacheable = True
+            if self.remote_client is not None:
+                try:
+                    remote = self.remote_client.analyze_latest(frame_bgr)
+                    if remote is None:
+                        return None  # ยังไม่มีผลจากเซิร์ฟเวอร์
+                    analyzed = (remote["emotion"], remote["confidence"]) if remote["emotion"] else None
+                    # ผลจาก pipeline เป็นของเฟรมก่อนหน้า จึงไม่เก็บแคชด้วย hash ของเฟรมนี้
+                    cacheable = False
+                except (ConnectionError, InferenceServerError):
+                    # เซิร์ฟเวอร์ไม่ตอบสนองหรือตอบกลับด้วยข้อผิดพลาด ใช้การวิเคราะห์บนเครื่องแทน
+                    if self.analyze_fn is None:
+                        return self.detect_faces_simple(frame, analysis_frame)
+                    analyzed = self.analyze_fn(frame_bgr)
+            else:
+                analyzed = self.analyze_fn(frame_bgr)
+            
+            if analyzed is not None:
+                emotion, confidence = analyzed
                 satisfaction_level = min(5, max(1, int(confidence / 20) + 1))
                 satisfaction_text = "★" * satisfaction_level
                 
                 result = (
-                    emotion_map.get(emotion, emotion),
+                    emotion,
                     confidence,
                     satisfaction_level,
                     satisfaction_text
                 )
                 
                 # เก็บผลลัพธ์ในแคช
-                self.emotion_cache[frame_hash] = result
-                if len(self.emotion_cache) > EMOTION_CACHE_SIZE:
-                    self.emotion_cache.pop(next(iter(self.emotion_cache)))
+                if cacheable:
+                    self.emotion_cache[frame_hash] = result
+                    if len(self.emotion_cache) > EMOTION_CACHE_SIZE:
+                        self.emotion_cache.pop(next(iter(self.emotion_cache)))
                 
                 # บันทึกข้อมูล
                 self.save_to_excel(*result)
+                self.save_emotion_data(emotion, confidence, satisfaction_level)
                 
                 return result
             else:
@@ -549,27 +2116,44 @@ class RaspberryPi4CameraDetector:
                 
         except Exception as e:
             print(f"DeepFace error: {e}")
-            return self.detect_faces_simple(frame)
+            return self.detect_faces_simple(frame, analysis_frame)
     
-    def detect_faces_simple(self, frame):
-        """ตรวจจับใบหน้าแบบง่าย พร้อมจัดการสี"""
+    def has_face(self, analysis_frame):
+        """ตรวจว่ามีใบหน้าในเฟรมวิเคราะห์หรือไม่ด้วย Haar cascade (ไม่วาดกรอบ)"""
+        if len(analysis_frame.shape) == 3:
+            gray = cv2.cvtColor(analysis_frame, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = analysis_frame
+        faces = self.face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(12, 12))
+        return len(faces) > 0
+
+    def detect_faces_simple(self, frame, analysis_frame=None):
+        """ตรวจจับใบหน้าแบบง่าย พร้อมจัดการสี (ตรวจบนเฟรมวิเคราะห์ วาดบนเฟรมแสดงผล)"""
         try:
             if self.face_cascade is None:
                 return "no_cascade", 0.0
             
+            source = analysis_frame if analysis_frame is not None else frame
+            
             # แปลงเป็น grayscale สำหรับ face detection
-            if len(frame.shape) == 3:
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if len(source.shape) == 3:
+                gray = cv2.cvtColor(source, cv2.COLOR_BGR2GRAY)
             else:
-                gray = frame
-                
+                gray = source
+            
+            # ลดขนาดใบหน้าขั้นต่ำตามสัดส่วนของเฟรมวิเคราะห์
+            min_side = max(12, int(30 * gray.shape[1] / frame.shape[1]))
             faces = self.face_cascade.detectMultiScale(
                 gray, 
                 scaleFactor=1.1, 
                 minNeighbors=5, 
-                minSize=(30, 30)
+                minSize=(min_side, min_side)
             )
             
+            # แปลงพิกัดกลับเป็นพิกัดเฟรมแสดงผล
+            if len(faces) > 0 and source is not frame:
+                faces = scale_boxes(faces, source.shape, frame.shape)
+            
             # วาดกรอบรอบใบหน้าที่ตรวจพบ
             if len(faces) > 0:
                 for (x, y, w, h) in faces:
@@ -637,19 +2221,11 @@ class RaspberryPi4CameraDetector:
         
         return frame
     
-    def save_emotion_data(self, emotion, confidence):
-        """บันทึกข้อมูลอารมณ์"""
-        timestamp = datetime.now().isoformat()
-        data = {
-            'timestamp': timestamp,
-            'emotion': emotion,
-            'confidence': confidence,
-            'camera_method': self.camera_method
-        }
-        self.emotion_history.append(data)
-        
-        if len(self.emotion_history) > 100:
-            self.emotion_history.pop(0)
+    def save_emotion_data(self, emotion, confidence, satisfaction_level=0):
+        """บันทึกข้อมูลอารมณ์ลงประวัติในหน่วยความจำ"""
+        self.emotion_history.append(
+            emotion, confidence, satisfaction_level, self.camera_method
+        )
     
     def run(self):
         """เริ่มการทำงานหลัก"""
@@ -671,18 +2247,32 @@ class RaspberryPi4CameraDetector:
         print("=" * 60)
         
         self.is_running = True
+        self.thread_budget.pin("inference")
+        self.start_save_thread()
+        self.capture_supervisor.start()
+        self.clip_recorder = ClipRecorder(
+            max_clips=self.clip_max_files,
+            max_bytes=self.clip_max_mb * 1024 * 1024,
+            thread_initializer=lambda: self.thread_budget.pin("persistence")
+        )
+        last_no_frame_log = 0.0
         frame_count = 0
         fps_start_time = time.time()
         last_fps_update = time.time()
         fps = 0
+        display_frame = None
         
         try:
             while True:
                 frame = self.get_frame()
                 
                 if frame is None:
-                    print("❌ Error: Can't receive frame")
-                    time.sleep(0.1)
+                    # get_frame รอเฟรมอยู่แล้ว ระหว่างนี้ supervisor เชื่อมต่อกล้องใหม่ในเบื้องหลัง
+                    if time.time() - last_no_frame_log >= 2.0:
+                        print(f"❌ Error: Can't receive frame ({self.capture_supervisor.state})")
+                        last_no_frame_log = time.time()
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        break
                     continue
                 
                 frame_count += 1
@@ -691,16 +2281,10 @@ class RaspberryPi4CameraDetector:
                 if frame_count % FRAME_SKIP != 0:
                     continue
                 
-                # ตรวจจับอารมณ์
-                result = self.detect_emotion_deepface(frame)
-                if result:
-                    emotion, confidence, satisfaction_level, satisfaction_text = result
-                    display_frame = self.add_overlay_info(
-                        frame, emotion, confidence, satisfaction_level, satisfaction_text
-                    )
-                    
-                    if display_frame is not None:
-                        cv2.imshow('Emotion Detection', display_frame)
+                shown = self.process_frame(frame)
+                if shown is not None:
+                    display_frame = shown
+                    cv2.imshow('Emotion Detection', display_frame)
                 
                 # อัพเดท FPS ทุก 1 วินาที
                 current_time = time.time()
@@ -716,9 +2300,10 @@ class RaspberryPi4CameraDetector:
                 if key == ord('q'):
                     break
                 elif key == ord('s') or key == 32:
+                    snapshot = display_frame if display_frame is not None else frame
                     filename = f"emotion_screenshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                    cv2.imwrite(filename, display_frame)
-                    print(f"📸 Screenshot saved: {filename}")
+                    # เขียนไฟล์ในเธรดพื้นหลัง ไม่ให้หน้าจอค้าง
+                    self.clip_recorder.save_snapshot(snapshot.copy(), filename)
                 elif key == ord('i'):
                     self.show_camera_info()
                 elif key == ord('c'):
@@ -738,6 +2323,48 @@ class RaspberryPi4CameraDetector:
         finally:
             self.cleanup()
     
+    def process_frame(self, frame, now=None):
+        """ประมวลผลเฟรมหนึ่งเฟรม (คลิป, ตรวจจับ, overlay) คืนค่าเฟรมแสดงผลหรือ None"""
+        # เก็บเฟรมดิบสำหรับ pre-roll ก่อนวาดกรอบ/ข้อมูลลงบนเฟรม
+        if self.clips_enabled:
+            self.clip_recorder.add_frame(frame, now)
+        
+        # ตรวจจับอารมณ์บนสตรีมความละเอียดต่ำ
+        analysis_frame = self.get_analysis_frame(frame)
+        result = self.detect_emotion_deepface(frame, analysis_frame)
+        if not result:
+            return None
+        
+        # detect_faces_simple คืนค่าเพียง (สถานะ, จำนวนใบหน้า)
+        if len(result) == 2:
+            result = (*result, 0, "")
+        emotion, confidence, satisfaction_level, satisfaction_text = result
+        
+        if self.clips_enabled:
+            self.check_clip_events(emotion, confidence, now, analysis_frame)
+        return self.add_overlay_info(
+            frame, emotion, confidence, satisfaction_level, satisfaction_text
+        )
+    
+    def check_clip_events(self, emotion, confidence, now=None, analysis_frame=None):
+        """ทริกเกอร์คลิปเมื่อพบอารมณ์ลบที่รุนแรงหรือใบหน้าใหม่"""
+        if emotion == "face_detected":
+            face_present = confidence > 0
+        elif emotion in ("No Face", "no_cascade", "error"):
+            face_present = False
+        elif self.face_cascade is not None and analysis_frame is not None:
+            # DeepFace (enforce_detection=False) คืนอารมณ์แม้ไม่มีใบหน้า จึงยืนยันด้วย Haar
+            face_present = self.has_face(analysis_frame)
+        else:
+            face_present = True
+        
+        if face_present and not self._face_present:
+            self.clip_recorder.trigger("new_face", now)
+        self._face_present = face_present
+        
+        if emotion in NEGATIVE_EMOTIONS and confidence >= CLIP_NEGATIVE_CONFIDENCE:
+            self.clip_recorder.trigger(f"negative_{emotion.lower()}", now)
+    
     def toggle_color_mode(self):
         """สลับโหมดสี"""
         if self.color_mode == "color":
@@ -768,6 +2395,8 @@ class RaspberryPi4CameraDetector:
                 self.picam2.set_controls({"Contrast": self.contrast})
             except:
                 pass
+    
+    def show_camera_info(self):
         """แสดงข้อมูลกล้อง"""
         print("\n📷 Camera Information:")
         print(f"   Method: {self.camera_method}")
@@ -781,47 +2410,477 @@ class RaspberryPi4CameraDetector:
             fps = self.cap.get(cv2.CAP_PROP_FPS)
             print(f"   Resolution: {int(width)}x{int(height)}")
             print(f"   FPS Setting: {fps}")
+        
+        metrics = self.capture_supervisor.metrics()
+        print(f"   Capture state: {metrics['state']}")
+        print(f"   Reconnects/failovers: {metrics['reconnects']}/{metrics['failovers']}")
+        print(f"   Camera downtime: {metrics['downtime_s']}s")
     
     def cleanup(self):
         """ทำความสะอาดและบันทึกข้อมูลสุดท้าย"""
         print("🧹 Cleaning up...")
         
         self.is_running = False
+        self.capture_supervisor.stop()
         
-        if self.picam2:
-            try:
-                self.picam2.stop()
-            except:
-                pass
+        metrics = self.capture_supervisor.metrics()
+        if metrics["reconnects"] or metrics["failovers"]:
+            print(f"🩺 Capture: {metrics['reconnects']} reconnects, {metrics['failovers']} failovers, "
+                  f"{metrics['downtime_s']}s downtime")
         
-        if self.cap:
-            self.cap.release()
+        self._stop_capture()
+        
+        if self.remote_client:
+            self.remote_client.close()
+        
+        # บันทึกค่าความสว่าง/คอนทราสต์ล่าสุดไว้ใช้ครั้งถัดไป
+        if self.camera_type in ("laptop", "pi"):
+            self.save_camera_cache()
+        
+        if self.clip_recorder:
+            self.clip_recorder.close()
         
-        cv2.destroyAllWindows()
+        try:
+            cv2.destroyAllWindows()
+        except cv2.error:
+            pass  # OpenCV แบบ headless ไม่มี highgui
         
         # บันทึกข้อมูลที่เหลือในคิว
+        if self.save_thread:
+            self.save_thread.join(timeout=2)
+        if self.excel_thread:
+            self.excel_thread.join(timeout=2)
         try:
             while not self.data_queue.empty():
                 data = self.data_queue.get_nowait()
-                self._save_to_excel_internal(*data)
-            self._save_excel_file()
+                self._append_log_row(data)
+                with self._excel_lock:
+                    self._excel_pending.append(data)
+            self._flush_excel()
         except:
             pass
         
+        if self._log_fh:
+            self._log_fh.close()
+            self._log_fh = None
+        
         if self.emotion_history:
             print(f"📊 Total emotions detected: {len(self.emotion_history)}")
             
-            emotions = [record['emotion'] for record in self.emotion_history]
-            unique_emotions = set(emotions)
+            total = len(self.emotion_history)
             print("📈 Emotion statistics:")
-            for emotion in unique_emotions:
-                count = emotions.count(emotion)
-                percentage = (count / len(emotions)) * 100
+            for emotion, count in self.emotion_history.counts().items():
+                percentage = (count / total) * 100
                 print(f"   {emotion}: {count} times ({percentage:.1f}%)")
         
         print("✅ Cleanup completed")
 
+def synthetic_emotion(frame_bgr):
+    """ตัวจำแนกอารมณ์จำลองแบบ deterministic สำหรับ soak test เมื่อไม่มี DeepFace"""
+    labels = list(EMOTION_MAP.values())
+    value = int(frame_bgr[::16, ::16].sum())
+    return labels[value % len(labels)], float(40 + value % 60)
+
+def read_rss_mb():
+    """อ่านขนาด RSS ปัจจุบันของโปรเซส (MB)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        # ไม่มี /proc (เช่น macOS): ใช้ค่าสูงสุดแทน
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+
+def make_headless_detector(workdir, source=None, thread_budget=None):
+    """สร้าง detector ที่ใช้กล้องจำลองและเขียนไฟล์ลง workdir สำหรับ soak test/benchmark"""
+    # เขียนไฟล์ทั้งหมดลงไดเรกทอรีชั่วคราว ไม่ให้ปนกับข้อมูลจริง
+    detector = RaspberryPi4CameraDetector(
+        excel_file=os.path.join(workdir, "emotion_data.xlsx"),
+        log_file=os.path.join(workdir, "emotion_log.csv"),
+    )
+    detector.camera_type = "simulated"
+    detector.simulated_source = source
+    detector.simulated_realtime = False
+    if thread_budget is not None:
+        detector.thread_budget = thread_budget
+    detector.clip_recorder = ClipRecorder(
+        output_dir=os.path.join(workdir, "clips"),
+        thread_initializer=lambda: detector.thread_budget.pin("persistence")
+    )
+    # เวลาเร่ง: ไม่จำกัดความถี่การวิเคราะห์ตามเวลาจริง
+    detector.min_emotion_interval = 0
+    if detector.analyze_fn is None:
+        detector.analyze_fn = synthetic_emotion
+    return detector
+
+class SoakTest:
+    """ขับ pipeline ทั้งหมดจากกล้องจำลองด้วยความเร็วเร่ง เพื่อตรวจหน่วยความจำรั่วและ latency ที่แย่ลง"""
+
+    def __init__(self, hours=1.0, fps=30, source=None, sample_interval=SOAK_SAMPLE_INTERVAL,
+                 warmup_fraction=0.05, max_rss_growth_mb=SOAK_MAX_RSS_GROWTH_MB,
+                 max_traced_growth_mb=SOAK_MAX_TRACED_GROWTH_MB,
+                 max_latency_drift=SOAK_MAX_LATENCY_DRIFT,
+                 max_dropped_ratio=SOAK_MAX_DROPPED_RATIO, thread_budget=None):
+        self.hours = hours
+        self.thread_budget = thread_budget or ThreadBudget()
+        self.fps = fps
+        self.source = source
+        self.sample_interval = sample_interval
+        self.warmup_fraction = warmup_fraction
+        self.max_rss_growth_mb = max_rss_growth_mb
+        self.max_traced_growth_mb = max_traced_growth_mb
+        self.max_latency_drift = max_latency_drift
+        self.max_dropped_ratio = max_dropped_ratio
+        self.samples = []
+
+    def _sample(self, detector, frame_index, latencies, wall_start):
+        latencies_ms = np.asarray(latencies) * 1000
+        traced, _ = tracemalloc.get_traced_memory()
+        sample = {
+            "sim_hours": round(frame_index / self.fps / 3600, 3),
+            "wall_s": round(time.time() - wall_start, 1),
+            "rss_mb": round(read_rss_mb(), 2),
+            "traced_mb": round(traced / 1e6, 2),
+            "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+            "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+            "history": len(detector.emotion_history),
+            "queue": detector.data_queue.qsize(),
+            "queued_records": detector.queued_records,
+            "dropped_records": detector.dropped_records,
+            "camera_downtime_s": detector.capture_supervisor.metrics()["downtime_s"],
+        }
+        self.samples.append(sample)
+        print(f"⏱️ sim {sample['sim_hours']:.2f}h | RSS {sample['rss_mb']:.1f} MB | "
+              f"traced {sample['traced_mb']:.1f} MB | p95 {sample['p95_ms']:.2f} ms | "
+              f"dropped {sample['dropped_records']}")
+        return sample
+
+    def run(self):
+        """รัน soak test คืนค่ารายงาน (dict) ที่มี key 'passed'"""
+        workdir = tempfile.mkdtemp(prefix="emotion_soak_")
+        detector = make_headless_detector(workdir, self.source, self.thread_budget)
+        if not detector.setup_camera():
+            shutil.rmtree(workdir, ignore_errors=True)
+            return {"passed": False, "failures": ["camera setup failed"], "samples": []}
+        
+        detector.is_running = True
+        detector.thread_budget.pin("inference")
+        detector.start_save_thread()
+        detector.capture_supervisor.start()
+        
+        total_frames = int(self.hours * 3600 * self.fps)
+        warmup_frames = int(total_frames * self.warmup_fraction)
+        # รันสั้นต้องย่อช่วง snapshot ไม่งั้นได้ sample เดียวแล้ว baseline == final เสมอ
+        interval = min(self.sample_interval,
+                       (total_frames - warmup_frames) / self.fps / SOAK_MIN_SAMPLES)
+        frames_per_sample = max(1, int(interval * self.fps))
+        print(f"🧪 Soak test: {self.hours}h simulated, {total_frames} frames, workdir {workdir}")
+        
+        tracemalloc.start(10)
+        wall_start = time.time()
+        sim_start = wall_start
+        latencies = []
+        baseline = None
+        baseline_snapshot = None
+        
+        try:
+            for index in range(1, total_frames + 1):
+                started = time.perf_counter()
+                frame = detector.get_frame()
+                if frame is not None and index % FRAME_SKIP == 0:
+                    detector.process_frame(frame, sim_start + index / self.fps)
+                latencies.append(time.perf_counter() - started)
+                
+                # ช่วงสุดท้ายที่สั้นเกินไปรวมเข้ากับ sample สุดท้าย ไม่งั้น p95 ของไม่กี่เฟรมแกว่งมาก
+                due = index % frames_per_sample == 0 and total_frames - index >= frames_per_sample // 2
+                if due or index == total_frames:
+                    sample = self._sample(detector, index, latencies, wall_start)
+                    latencies = []
+                    if baseline is None and index >= warmup_frames:
+                        baseline = sample
+                        baseline_snapshot = tracemalloc.take_snapshot()
+            
+            final_snapshot = tracemalloc.take_snapshot()
+        except KeyboardInterrupt:
+            print("\n⚠️ Interrupted by user")
+            final_snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+            detector.cleanup()
+            shutil.rmtree(workdir, ignore_errors=True)
+        
+        report = self._evaluate(baseline, final_snapshot, baseline_snapshot)
+        self.print_report(report)
+        return report
+
+    def _evaluate(self, baseline, final_snapshot, baseline_snapshot):
+        if baseline is None or not self.samples:
+            return {"passed": False, "failures": ["no samples collected"], "samples": self.samples}
+        
+        post_warmup = self.samples[self.samples.index(baseline):]
+        if len(post_warmup) < 2:
+            return {"passed": False, "failures": [
+                f"not enough samples after warm-up ({len(post_warmup)}, need at least 2)"
+            ], "samples": self.samples}
+        
+        final = self.samples[-1]
+        offered = final["queued_records"] + final["dropped_records"]
+        dropped_ratio = final["dropped_records"] / offered if offered else 0.0
+        rss_growth = final["rss_mb"] - baseline["rss_mb"]
+        traced_growth = final["traced_mb"] - baseline["traced_mb"]
+        # เทียบค่ากลางของ p95 ครึ่งหลังกับครึ่งแรก ช่วงกระตุกสั้นๆ (เช่นตอนเขียนคลิป) จึงไม่นับเป็น drift
+        half = len(post_warmup) // 2
+        early_p95 = float(np.median([sample["p95_ms"] for sample in post_warmup[:half]]))
+        late_p95 = float(np.median([sample["p95_ms"] for sample in post_warmup[half:]]))
+        latency_drift = late_p95 / early_p95 if early_p95 > 0 else 1.0
+        
+        failures = []
+        if rss_growth > self.max_rss_growth_mb:
+            failures.append(f"RSS grew {rss_growth:.1f} MB (limit {self.max_rss_growth_mb} MB)")
+        if traced_growth > self.max_traced_growth_mb:
+            failures.append(f"Python heap grew {traced_growth:.1f} MB (limit {self.max_traced_growth_mb} MB)")
+        if latency_drift > self.max_latency_drift:
+            failures.append(f"p95 latency drifted x{latency_drift:.2f} (limit x{self.max_latency_drift})")
+        if dropped_ratio > self.max_dropped_ratio:
+            failures.append(f"save queue saturated: dropped {final['dropped_records']}/{offered} records "
+                            f"({dropped_ratio:.1%}, limit {self.max_dropped_ratio:.1%})")
+        
+        top_growth = []
+        if baseline_snapshot is not None:
+            for stat in final_snapshot.compare_to(baseline_snapshot, "lineno")[:5]:
+                frame = stat.traceback[0]
+                top_growth.append({
+                    "location": f"{frame.filename}:{frame.lineno}",
+                    "size_diff_kb": round(stat.size_diff / 1024, 1),
+                })
+        
+        return {
+            "passed": not failures,
+            "failures": failures,
+            "rss_growth_mb": round(rss_growth, 2),
+            "traced_growth_mb": round(traced_growth, 2),
+            "latency_drift": round(latency_drift, 3),
+            "dropped_ratio": round(dropped_ratio, 4),
+            "top_growth": top_growth,
+            "samples": self.samples,
+        }
+
+    def print_report(self, report):
+        print("=" * 60)
+        print("🧪 Soak test report")
+        if "rss_growth_mb" in report:
+            print(f"   RSS growth: {report['rss_growth_mb']} MB")
+            print(f"   Python heap growth: {report['traced_growth_mb']} MB")
+            print(f"   p95 latency drift: x{report['latency_drift']}")
+            print(f"   Dropped records: {report['dropped_ratio']:.1%}")
+            for item in report["top_growth"]:
+                print(f"   +{item['size_diff_kb']} KB at {item['location']}")
+        if report["passed"]:
+            print("✅ Soak test passed")
+        else:
+            for failure in report["failures"]:
+                print(f"❌ {failure}")
+        print("=" * 60)
+
+def benchmark_thread_budget_worker(budget, frames=BENCHMARK_FRAMES, source=None):
+    """วัด throughput ของ pipeline ด้วยค่าเธรดหนึ่งชุด (รันในโปรเซสแยก)"""
+    budget.apply()
+    workdir = tempfile.mkdtemp(prefix="emotion_bench_")
+    detector = make_headless_detector(workdir, source, budget)
+    try:
+        if not detector.setup_camera():
+            return None
+        detector.is_running = True
+        budget.pin("inference")
+        detector.start_save_thread()
+        
+        warmup = max(1, frames // 10)
+        latencies = []
+        for index in range(frames + warmup):
+            started = time.perf_counter()
+            frame = detector.get_frame()
+            if frame is not None:
+                detector.process_frame(frame)
+            if index >= warmup:
+                latencies.append(time.perf_counter() - started)
+        
+        latencies_ms = np.asarray(latencies) * 1000
+        return {
+            "fps": round(1000 / float(latencies_ms.mean()), 2),
+            "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+        }
+    finally:
+        detector.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def thread_budget_candidates(cores=None):
+    """สร้างชุดค่าเธรด/affinity ที่จะทดสอบตามจำนวน core ของเครื่อง"""
+    cores = cores or os.cpu_count() or 1
+    thread_counts = sorted({1, min(2, cores), cores})
+    tf_counts = thread_counts if DEEPFACE_AVAILABLE else [None]
+    # inter-op มีผลเมื่อกราฟมีหลาย op ทำงานขนานกันได้ จึงทดสอบแค่ 1 และ 2
+    inter_counts = sorted({1, min(2, cores)}) if DEEPFACE_AVAILABLE else [None]
+    
+    affinities = [{}]
+    if cores >= 3 and hasattr(os, "sched_setaffinity"):
+        # แยก capture และ persistence ออกจาก core ที่ใช้ inference
+        affinities.append({
+            "capture": [0],
+            "inference": list(range(1, cores - 1)),
+            "persistence": [cores - 1],
+        })
+    
+    return [
+        ThreadBudget(cv_threads, tf_intra, tf_inter, affinity)
+        for cv_threads in thread_counts
+        for tf_intra in tf_counts
+        for tf_inter in inter_counts
+        for affinity in affinities
+    ]
+
+def run_thread_benchmark(frames=BENCHMARK_FRAMES, source=None, output=THREAD_BUDGET_FILE):
+    """ทดสอบทุกชุดค่าเธรดในโปรเซสแยก (TensorFlow ตั้งจำนวนเธรดได้ครั้งเดียวต่อโปรเซส)"""
+    candidates = thread_budget_candidates()
+    print(f"🏁 Benchmarking {len(candidates)} thread configurations, {frames} frames each...")
+    results = []
+    
+    for budget in candidates:
+        command = [sys.executable, os.path.abspath(__file__),
+                   "--benchmark-worker", json.dumps(budget.to_dict()),
+                   "--benchmark-frames", str(frames)]
+        if source:
+            command += ["--soak-source", source]
+        try:
+            completed = subprocess.run(command, capture_output=True, text=True, timeout=600)
+            lines = completed.stdout.strip().splitlines()
+            metrics = json.loads(lines[-1]) if completed.returncode == 0 and lines else None
+        except (subprocess.TimeoutExpired, ValueError):
+            metrics = None
+        
+        if metrics is None:
+            print(f"   ❌ {budget.describe()}: failed")
+            continue
+        print(f"   {budget.describe()}: {metrics['fps']:.1f} FPS, p95 {metrics['p95_ms']:.2f} ms")
+        results.append((budget, metrics))
+    
+    if not results:
+        print("❌ No configuration completed")
+        return None
+    
+    # เลือก FPS สูงสุด ถ้าใกล้กัน (ต่างไม่เกิน 2%) เลือก p95 ต่ำกว่า
+    best_fps = max(metrics["fps"] for _, metrics in results)
+    contenders = [item for item in results if item[1]["fps"] >= best_fps * 0.98]
+    best, metrics = min(contenders, key=lambda item: item[1]["p95_ms"])
+    
+    print(f"🏆 Recommended: {best.describe()} ({metrics['fps']:.1f} FPS, p95 {metrics['p95_ms']:.2f} ms)")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({**best.to_dict(), "benchmark": metrics}, f, indent=2)
+    print(f"💾 Saved to {output} (loaded automatically on next start)")
+    return best
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ระบบตรวจจับอารมณ์ด้วยกล้อง")
+    parser.add_argument("--serve", action="store_true",
+                        help="run as a LAN emotion inference server")
+    parser.add_argument("--host", default="0.0.0.0", help="server bind address")
+    parser.add_argument("--port", type=int, default=INFERENCE_PORT, help="server port")
+    parser.add_argument("--server", metavar="HOST[:PORT]",
+                        help="offload emotion classification to an inference server")
+    parser.add_argument("--server-encoding", choices=["jpeg", "raw"], default="jpeg",
+                        help="image encoding used when sending crops to the server")
+    parser.add_argument("--no-clips", action="store_true",
+                        help="disable automatic event clip capture")
+    parser.add_argument("--clips-max-files", type=int, default=CLIP_MAX_FILES,
+                        help="keep at most this many clips (oldest are deleted)")
+    parser.add_argument("--clips-max-mb", type=float, default=CLIP_MAX_MB,
+                        help="keep the clips directory under this size in MB")
+    parser.add_argument("--soak", type=float, metavar="HOURS",
+                        help="run an accelerated soak test for HOURS of simulated time")
+    parser.add_argument("--soak-source", help="video/image file to drive the soak test")
+    parser.add_argument("--soak-report", help="write the soak test report as JSON")
+    parser.add_argument("--soak-max-rss-mb", type=float, default=SOAK_MAX_RSS_GROWTH_MB)
+    parser.add_argument("--soak-max-heap-mb", type=float, default=SOAK_MAX_TRACED_GROWTH_MB)
+    parser.add_argument("--soak-max-latency-drift", type=float, default=SOAK_MAX_LATENCY_DRIFT)
+    parser.add_argument("--soak-max-dropped", type=float, default=SOAK_MAX_DROPPED_RATIO,
+                        help="maximum fraction of records dropped by a full save queue")
+    parser.add_argument("--cv-threads", type=int, help="OpenCV worker threads")
+    parser.add_argument("--tf-intra", type=int, help="TensorFlow intra-op threads")
+    parser.add_argument("--tf-inter", type=int, help="TensorFlow inter-op threads")
+    parser.add_argument("--pin", metavar="ROLE=CORES,...", type=affinity_spec_argument,
+                        help="pin threads to cores, e.g. capture=0,inference=1-2,persistence=3")
+    parser.add_argument("--benchmark-threads", action="store_true",
+                        help="sweep thread configurations and save the fastest")
+    parser.add_argument("--benchmark-frames", type=int, default=BENCHMARK_FRAMES)
+    parser.add_argument("--benchmark-worker", help=argparse.SUPPRESS)
+    parser.add_argument("--report", nargs="?", const="emotion_log.csv", metavar="LOG",
+                        help="summarize a detection log (CSV or Excel) and exit")
+    parser.add_argument("--report-output", default="emotion_report.xlsx",
+                        help="report file (.xlsx for a styled workbook, .csv for CSV tables)")
+    return parser.parse_args(argv)
+
+def make_remote_client(address, encoding="jpeg"):
+    """สร้าง RemoteEmotionClient จากสตริง HOST[:PORT]"""
+    host, _, port = address.partition(":")
+    return RemoteEmotionClient(host, int(port) if port else INFERENCE_PORT, encoding=encoding)
+
+def build_thread_budget(args):
+    """รวมค่าเธรดจากไฟล์ benchmark กับค่าจาก command line"""
+    budget = load_thread_budget()
+    if args.cv_threads is not None:
+        budget.cv_threads = args.cv_threads
+    if args.tf_intra is not None:
+        budget.tf_intra = args.tf_intra
+    if args.tf_inter is not None:
+        budget.tf_inter = args.tf_inter
+    if args.pin:
+        budget.affinity = args.pin
+    return budget
+
 def main():
+    args = parse_args()
+    
+    if args.report:
+        sys.exit(0 if run_report(args.report, args.report_output) else 1)
+    
+    if args.benchmark_worker:
+        budget = ThreadBudget.from_dict(json.loads(args.benchmark_worker))
+        metrics = benchmark_thread_budget_worker(budget, args.benchmark_frames, args.soak_source)
+        print(json.dumps(metrics))
+        sys.exit(0 if metrics else 1)
+    
+    if args.benchmark_threads:
+        run_thread_benchmark(args.benchmark_frames, args.soak_source)
+        return
+    
+    thread_budget = build_thread_budget(args)
+    thread_budget.apply()
+    print(f"🧵 Thread budget: {thread_budget.describe()}")
+    
+    if args.soak:
+        report = SoakTest(
+            hours=args.soak,
+            source=args.soak_source,
+            max_rss_growth_mb=args.soak_max_rss_mb,
+            max_traced_growth_mb=args.soak_max_heap_mb,
+            max_latency_drift=args.soak_max_latency_drift,
+            max_dropped_ratio=args.soak_max_dropped,
+            thread_budget=thread_budget,
+        ).run()
+        if args.soak_report:
+            with open(args.soak_report, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        sys.exit(0 if report["passed"] else 1)
+    
+    if args.serve:
+        if not DEEPFACE_AVAILABLE:
+            print("❌ DeepFace is required for server mode")
+            return
+        EmotionInferenceServer(args.host, args.port).serve_forever()
+        return
+    
     print("🎭 ระบบตรวจจับอารมณ์ด้วยกล้อง")
     print("🎨 เวอร์ชัน 2.2 - เลือกกล้องและปรับแต่งการแสดงผล")
     print("=" * 70)
@@ -830,18 +2889,22 @@ def main():
     print("\n🔧 เลือกประเภทกล้อง:")
     print("1. กล้องเว็บแคม (โน๊ตบุ๊ค)")
     print("2. กล้อง Raspberry Pi")
+    print("3. กล้องจำลอง (ทดสอบโดยไม่มีฮาร์ดแวร์)")
     
     while True:
         try:
-            choice = input("เลือกประเภทกล้อง (1-2): ").strip()
+            choice = input("เลือกประเภทกล้อง (1-3): ").strip()
             if choice == "1":
                 camera_type = "laptop"
                 break
             elif choice == "2":
                 camera_type = "pi"
                 break
+            elif choice == "3":
+                camera_type = "simulated"
+                break
             else:
-                print("❌ ตัวเลือกไม่ถูกต้อง กรุณาเลือก 1 หรือ 2")
+                print("❌ ตัวเลือกไม่ถูกต้อง กรุณาเลือก 1, 2 หรือ 3")
         except:
             print("❌ การป้อนข้อมูลไม่ถูกต้อง กรุณาลองใหม่")
     
@@ -859,7 +2922,13 @@ def main():
     detector = RaspberryPi4CameraDetector()
     detector.camera_type = camera_type
     detector.color_mode = color_mode
-    detector.check_camera_hardware()
+    detector.simulated_source = os.environ.get("EMOTION_SIM_SOURCE")
+    detector.clips_enabled = not args.no_clips
+    detector.clip_max_files = args.clips_max_files
+    detector.clip_max_mb = args.clips_max_mb
+    detector.thread_budget = thread_budget
+    if args.server:
+        detector.remote_client = make_remote_client(args.server, args.server_encoding)
     detector.run()
 
 if __name__ == "__main__":
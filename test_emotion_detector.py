@@ -0,0 +1,516 @@
+"""ทดสอบเซิร์ฟเวอร์วิเคราะห์อารมณ์และการกู้คืนกล้องของ CaptureSupervisor
+
+รันด้วย: python -m pytest -q test_emotion_detector.py
+"""
+import http.client
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+import emotion_detector as ed
+
+
+def stub_analyze(crop):
+    """คืนผลคงที่ ภาพสีขาวล้วนจำลองความผิดพลาดของโมเดล"""
+    if crop.size and crop.min() == 255:
+        raise RuntimeError("model failure")
+    return "Happy", 88.0
+
+
+@pytest.fixture
+def server():
+    srv = ed.EmotionInferenceServer("127.0.0.1", 0, analyze_fn=stub_analyze).start()
+    yield srv
+    srv.stop()
+
+
+def make_client(srv, **kwargs):
+    host, port = srv.address
+    return ed.RemoteEmotionClient(host, port, encoding="raw", **kwargs)
+
+
+def test_server_analyzes_batch(server):
+    client = make_client(server)
+    try:
+        crops = [np.zeros((16, 16, 3), dtype=np.uint8) for _ in range(3)]
+        assert client.analyze_batch(crops) == [{"emotion": "Happy", "confidence": 88.0}] * 3
+    finally:
+        client.close()
+
+
+def test_client_splits_batches_larger_than_server_limit(server):
+    client = make_client(server)
+    try:
+        crops = [np.zeros((8, 8, 3), dtype=np.uint8)] * (ed.MAX_INFERENCE_BATCH * 2 + 1)
+        assert len(client.analyze_batch(crops)) == len(crops)
+    finally:
+        client.close()
+
+
+def test_http_error_does_not_trigger_backoff(server):
+    client = make_client(server)
+    try:
+        with pytest.raises(ed.InferenceServerError) as info:
+            client.analyze_batch([np.full((8, 8, 3), 255, dtype=np.uint8)])
+        assert info.value.status == 500
+        assert client.available
+        # connection เดิมยังใช้ต่อได้หลัง HTTP error
+        assert len(client.analyze_batch([np.zeros((8, 8, 3), dtype=np.uint8)])) == 1
+    finally:
+        client.close()
+
+
+def test_network_error_triggers_backoff(server):
+    client = make_client(server, retry_interval=60)
+    try:
+        # ใช้งานก่อนหนึ่งครั้งเพื่อให้มี connection keep-alive ค้างใน pool
+        assert len(client.analyze_batch([np.zeros((8, 8, 3), dtype=np.uint8)])) == 1
+        server.stop()
+        with pytest.raises(ConnectionError):
+            client.analyze_batch([np.zeros((8, 8, 3), dtype=np.uint8)])
+        assert not client.available
+    finally:
+        client.close()
+
+
+def post_raw(srv, body, headers=None):
+    host, port = srv.address
+    conn = http.client.HTTPConnection(host, port, timeout=5)
+    try:
+        conn.request("POST", "/analyze", body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def test_server_rejects_oversized_body_without_reading_it(server):
+    # ประกาศขนาดเกินแต่ไม่ส่ง body: เซิร์ฟเวอร์ต้องตอบทันทีแทนที่จะรออ่าน
+    conn = http.client.HTTPConnection(*server.address, timeout=5)
+    try:
+        conn.putrequest("POST", "/analyze")
+        conn.putheader("Content-Length", str(ed.MAX_INFERENCE_BODY_BYTES + 1))
+        conn.endheaders()
+        response = conn.getresponse()
+        assert response.status == 413
+    finally:
+        conn.close()
+
+
+def test_server_rejects_too_many_items_before_decoding(server):
+    # item ที่ถอดรหัสไม่ได้: ถ้าเซิร์ฟเวอร์ถอดรหัสก่อนจะได้ 400 แทน 413
+    items = [{"format": "jpeg", "data": "not-base64"}] * (ed.MAX_INFERENCE_BATCH + 1)
+    status, data = post_raw(server, json.dumps({"items": items}).encode("utf-8"))
+    assert status == 413
+
+
+@pytest.fixture
+def detector(tmp_path):
+    det = ed.RaspberryPi4CameraDetector(
+        excel_file=str(tmp_path / "emotion_data.xlsx"),
+        log_file=str(tmp_path / "emotion_log.csv"),
+    )
+    det.camera_type = "simulated"
+    det.simulated_realtime = True
+    det.fault_injector = ed.FaultInjector()
+    det.capture_supervisor = ed.CaptureSupervisor(
+        det, stall_timeout=0.4, frozen_timeout=0.4, max_errors=3,
+        backoff_initial=0.05, backoff_max=0.2, check_interval=0.05
+    )
+    yield det
+    det.is_running = False
+    det.capture_supervisor.stop()
+    det._stop_capture()
+
+
+def wait_for(condition, timeout=8.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+EXPECTED_COUNTER = {
+    "error": "errors",
+    "exception": "errors",
+    "hang": "stalls",
+    "freeze": "frozen_events",
+    "disconnect": "errors",
+}
+
+
+@pytest.mark.parametrize("kind", ed.FaultInjector.KINDS)
+def test_supervisor_recovers_from_fault(detector, kind):
+    assert detector.setup_camera()
+    supervisor = detector.capture_supervisor
+    supervisor.start()
+    assert wait_for(lambda: supervisor.metrics()["frames"] > 5)
+
+    detector.fault_injector.inject(kind, 0.8)
+    assert wait_for(lambda: supervisor.metrics()["reconnects"] + supervisor.metrics()["failovers"] >= 1)
+    metrics = supervisor.metrics()
+    assert metrics[EXPECTED_COUNTER[kind]] >= 1
+    assert metrics["downtime_s"] > 0
+
+    # หลังกู้คืนแล้วต้องได้เฟรมใหม่ต่อเนื่อง
+    assert wait_for(lambda: supervisor.metrics()["state"] == "running")
+    frames = supervisor.metrics()["frames"]
+    assert wait_for(lambda: supervisor.metrics()["frames"] > frames + 5)
+
+
+def test_static_scene_is_not_frozen(detector, tmp_path):
+    still = tmp_path / "still.png"
+    cv2.imwrite(str(still), np.full((120, 160, 3), 90, dtype=np.uint8))
+    detector.simulated_source = str(still)
+    assert detector.setup_camera()
+    supervisor = detector.capture_supervisor
+    supervisor.start()
+
+    time.sleep(1.5)
+    metrics = supervisor.metrics()
+    assert metrics["frames"] > 20
+    assert metrics["frozen_events"] == 0
+    assert metrics["reconnects"] == 0
+
+
+def test_cleanup_during_reconnect_leaves_capture_stopped(detector):
+    assert detector.setup_camera()
+    supervisor = detector.capture_supervisor
+    supervisor.start()
+    assert wait_for(lambda: supervisor.metrics()["frames"] > 5)
+
+    # read ค้างนานกว่าที่ cleanup รอ: supervisor ต้องไม่เปิดกล้องกลับมาหลัง cleanup
+    detector.fault_injector.inject("hang", 2.0)
+    assert wait_for(lambda: supervisor.state == "reconnecting")
+    detector.cleanup()
+    time.sleep(2.5)
+
+    assert not detector.is_running
+    assert detector.cap is None
+    assert not detector.capture_thread.is_alive()
+    assert supervisor.state == "stopped"
+
+
+def test_remote_failure_falls_back_to_local_analysis(server, tmp_path):
+    det = ed.RaspberryPi4CameraDetector(
+        excel_file=str(tmp_path / "emotion_data.xlsx"),
+        log_file=str(tmp_path / "emotion_log.csv"),
+    )
+    det.min_emotion_interval = 0
+    det.analyze_fn = lambda frame: ("Sad", 61.0)
+    det.remote_client = make_client(server)
+    try:
+        frames = (np.full((48, 64, 3), i, dtype=np.uint8) for i in range(200))
+
+        # เซิร์ฟเวอร์ทำงาน: ได้ผลจากเซิร์ฟเวอร์ (ตอบช้าไปหนึ่งเฟรมตาม pipeline)
+        assert wait_for(lambda: (det.detect_emotion_deepface(next(frames)) or ("",))[0] == "Happy")
+
+        server.stop()
+        # เซิร์ฟเวอร์หยุด: ตกกลับไปใช้ analyze_fn บนเครื่องและพักการเชื่อมต่อ
+        assert wait_for(lambda: (det.detect_emotion_deepface(next(frames)) or ("",))[0] == "Sad")
+        assert not det.remote_client.available
+    finally:
+        det.remote_client.close()
+
+
+def padded_i420(i420, width, height, stride):
+    """เติม padding ให้แต่ละระนาบของ I420 เหมือนบัฟเฟอร์ lores ของ PiCamera2"""
+    flat = i420.reshape(-1)
+    y = flat[:width * height].reshape(height, width)
+    u = flat[width * height:width * height * 5 // 4].reshape(height // 2, width // 2)
+    v = flat[width * height * 5 // 4:].reshape(height // 2, width // 2)
+
+    def pad(plane, plane_stride):
+        return np.pad(plane, ((0, 0), (0, plane_stride - plane.shape[1])), constant_values=7)
+
+    planes = [pad(y, stride), pad(u, stride // 2), pad(v, stride // 2)]
+    return np.concatenate([plane.ravel() for plane in planes]).reshape(height * 3 // 2, stride)
+
+
+def test_lores_to_bgr_crops_padded_planes():
+    width, height = ed.ANALYSIS_SIZE
+    rng = np.random.default_rng(0)
+    bgr = cv2.GaussianBlur(rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (15, 15), 5)
+    i420 = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420)
+    expected = ed.lores_to_bgr(i420, (width, height))
+
+    padded = padded_i420(i420, width, height, stride=width + 64)
+    assert np.array_equal(ed.lores_to_bgr(padded, (width, height)), expected)
+    gray = ed.lores_to_bgr(padded, (width, height), grayscale=True)
+    assert gray.shape == (height, width, 3)
+    assert np.array_equal(gray[..., 0], i420[:height])
+
+
+def test_scale_boxes_maps_analysis_boxes_to_display():
+    analysis_shape = (240, 320, 3)
+    display_shape = (480, 640, 3)
+    assert ed.scale_boxes([(10, 20, 30, 40)], analysis_shape, display_shape) == [(20, 40, 60, 80)]
+
+
+def test_downscale_frame_only_shrinks():
+    large = np.zeros((480, 640, 3), dtype=np.uint8)
+    small = np.zeros((120, 160, 3), dtype=np.uint8)
+    assert ed.downscale_frame(large).shape == (ed.ANALYSIS_SIZE[1], ed.ANALYSIS_SIZE[0], 3)
+    assert ed.downscale_frame(small) is small
+
+
+def test_get_analysis_frame_uses_lores_snapshot(tmp_path):
+    det = ed.RaspberryPi4CameraDetector(
+        excel_file=str(tmp_path / "emotion_data.xlsx"),
+        log_file=str(tmp_path / "emotion_log.csv"),
+    )
+    width, height = ed.ANALYSIS_SIZE
+    bgr = np.full((height, width, 3), (30, 120, 200), dtype=np.uint8)
+    i420 = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420)
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+
+    det.camera_method = "picamera2"
+    det.lores_enabled = True
+    det._frame_lores = padded_i420(i420, width, height, stride=width + 32)
+    analysis = det.get_analysis_frame(frame)
+    assert analysis.shape == (height, width, 3)
+    assert np.abs(analysis.astype(int) - bgr).max() <= 3
+
+    # ไม่มี lores: ย่อเฟรมแสดงผลด้วยซอฟต์แวร์
+    det.camera_method = "simulated"
+    assert det.get_analysis_frame(frame).shape == (height, width, 3)
+
+
+def test_simulated_camera_through_process_frame(detector):
+    analyzed_shapes = []
+
+    def analyze(frame_bgr):
+        analyzed_shapes.append(frame_bgr.shape)
+        return "Happy", 77.0
+
+    detector.analyze_fn = analyze
+    detector.min_emotion_interval = 0
+    detector.clips_enabled = False
+    assert detector.setup_camera()
+
+    displayed = None
+    for _ in range(10):
+        frame = detector.get_frame()
+        if frame is not None:
+            result = detector.process_frame(frame)
+            if result is not None:
+                displayed = result
+    assert displayed is not None
+    assert displayed.shape == (ed.DISPLAY_SIZE[1], ed.DISPLAY_SIZE[0], 3)
+    # การวิเคราะห์ทำบนเฟรมความละเอียดต่ำ ไม่ใช่เฟรมแสดงผล
+    assert analyzed_shapes and set(analyzed_shapes) == {(ed.ANALYSIS_SIZE[1], ed.ANALYSIS_SIZE[0], 3)}
+    assert len(detector.emotion_history) == len(analyzed_shapes)
+
+
+def make_recorder(tmp_path, **kwargs):
+    options = dict(output_dir=str(tmp_path / "clips"), pre_roll=0.5, post_roll=1.0,
+                   max_length=3.0, fps=10)
+    options.update(kwargs)
+    return ed.ClipRecorder(**options)
+
+
+def test_clip_trigger_extends_active_clip_up_to_max_length(tmp_path):
+    recorder = make_recorder(tmp_path)
+    try:
+        assert recorder.trigger("negative_sad", now=100.0)
+        assert not recorder.trigger("negative_sad", now=100.5)
+        assert recorder.active_clip["end_time"] == 101.5
+        # ทริกเกอร์ต่อเนื่องยืดได้ไม่เกิน max_length นับจากจุดเริ่ม
+        assert not recorder.trigger("negative_sad", now=102.8)
+        assert recorder.active_clip["end_time"] == 103.0
+    finally:
+        recorder.close()
+
+
+def test_clip_finishes_on_time_while_encodes_are_backed_up(tmp_path):
+    frame = np.zeros((60, 80, 3), dtype=np.uint8)
+    recorder = make_recorder(tmp_path, max_pending=0)  # ทุกเฟรมถูกทิ้งเหมือนงานเข้ารหัสค้าง
+    try:
+        triggered = 0
+        now = 100.0
+        while now < 110.0:
+            # ลำดับเดียวกับ process_frame: ส่งเฟรมก่อน แล้วจึงตรวจเหตุการณ์
+            recorder.add_frame(frame, now)
+            if recorder.trigger("new_face", now):
+                triggered += 1
+            now += 2.5
+        assert triggered == 4
+        assert recorder.dropped_frames > 0
+    finally:
+        recorder.close()
+
+
+def test_clip_retention_keeps_newest_clips(tmp_path):
+    frame = np.zeros((60, 80, 3), dtype=np.uint8)
+    recorder = make_recorder(tmp_path, max_clips=2)
+    for index in range(4):
+        start = 1000.0 + index * 10
+        recorder.trigger(f"event{index}", start)
+        recorder.add_frame(frame, start + 0.1)
+        recorder.add_frame(frame, start + 2.0)  # ครบ post_roll: ส่งคลิปไปเขียน
+        wait_for(lambda: recorder.clips_written == index + 1)
+    recorder.close()
+    clips = sorted(os.listdir(tmp_path / "clips"))
+    assert len(clips) == 2
+    assert clips[0].endswith("event2.mjpeg") and clips[1].endswith("event3.mjpeg")
+    assert recorder.clips_deleted == 2
+
+
+def test_clip_retention_limits_total_bytes(tmp_path):
+    recorder = make_recorder(tmp_path, max_bytes=2500)
+    clips_dir = tmp_path / "clips"
+    clips_dir.mkdir()
+    try:
+        for index in range(4):
+            path = clips_dir / f"clip_2026010{index}_000000_event.mjpeg"
+            path.write_bytes(b"x" * 1000)
+            os.utime(path, (1000 + index, 1000 + index))
+        (clips_dir / "notes.txt").write_bytes(b"x" * 5000)  # ไฟล์อื่นไม่ถูกลบ
+        recorder._enforce_retention()
+        assert sorted(p.name for p in clips_dir.iterdir()) == [
+            "clip_20260102_000000_event.mjpeg", "clip_20260103_000000_event.mjpeg", "notes.txt"
+        ]
+    finally:
+        recorder.close()
+
+
+def write_log(path, rng, days):
+    rows = []
+    for day in days:
+        for _ in range(rng.integers(5, 15)):
+            emotion = rng.choice(["Happy", "Sad", "Neutral", "Angry"])
+            confidence = round(float(rng.uniform(20, 99)), 2)
+            level = int(rng.integers(1, 6))
+            rows.append((day, f"{rng.integers(0, 24):02d}:{rng.integers(0, 60):02d}:00", emotion,
+                         f"{confidence:.2f}", level, "★" * level, rng.choice(["usb_0", "picamera2"])))
+    frame = pd.DataFrame(rows, columns=ed.LOG_COLUMNS)
+    frame.to_csv(path, index=False)
+    return frame
+
+
+def test_summarize_emotion_log_matches_direct_groupby(tmp_path):
+    rng = np.random.default_rng(1)
+    # วันที่มีช่องว่าง: หน้าต่าง 7 วันต้องนับตามปฏิทิน ไม่ใช่จำนวนแถว
+    days = ["2026-03-01", "2026-03-02", "2026-03-05", "2026-03-09", "2026-03-10", "2026-03-30"]
+    log = write_log(tmp_path / "emotion_log.csv", rng, days)
+    summary = ed.summarize_emotion_log(str(tmp_path / "emotion_log.csv"), chunksize=7)
+
+    log["confidence"] = log["confidence"].astype(float)
+    trend = summary["Satisfaction trend"]
+    by_day = log.groupby("date")
+    assert list(trend.index) == days
+    assert trend["records"].tolist() == by_day.size().tolist()
+    assert np.allclose(trend["avg_satisfaction"], by_day["satisfaction_level"].mean().round(3))
+    assert np.allclose(trend["avg_confidence"], by_day["confidence"].mean().round(2))
+
+    dates = pd.to_datetime(log["date"])
+    for day in days:
+        current = pd.Timestamp(day)
+        window = log[(dates > current - pd.Timedelta(days=7)) & (dates <= current)]
+        assert trend.loc[day, "satisfaction_7d"] == pytest.approx(
+            round(window["satisfaction_level"].mean(), 3))
+
+    per_camera = summary["Per camera"]
+    assert per_camera["records"].to_dict() == log.groupby("camera_method").size().to_dict()
+
+    hours = log["time"].str[:2].astype(int)
+    counts = log.groupby([hours, "emotion"]).size().unstack(fill_value=0)
+    share = counts.div(counts.sum(axis=1), axis=0).mul(100).round(2)
+    result = summary["Emotion share by hour"]
+    assert np.allclose(result.loc[share.index, share.columns].astype(float), share)
+
+
+def test_history_wraps_in_time_order():
+    history = ed.EmotionHistory(capacity=5)
+    emotions = ["Happy", "Sad", "Neutral", "Angry", "Happy", "Sad", "Happy", "Neutral"]
+    for i, emotion in enumerate(emotions):
+        history.append(emotion, float(i), satisfaction=3, camera="usb_0", timestamp=100.0 + i)
+
+    # เขียนทับ 3 รายการแรกแล้ว เหลือ index 3..7 เรียงจากเก่าไปใหม่
+    records = history.records()
+    assert len(history) == 5
+    assert records["timestamp_ms"].tolist() == [103000, 104000, 105000, 106000, 107000]
+    assert records["confidence"].tolist() == [3.0, 4.0, 5.0, 6.0, 7.0]
+    assert history.counts() == {"Angry": 1, "Happy": 2, "Sad": 1, "Neutral": 1}
+
+    recent = history.since(2.5, now=107.0)
+    assert recent["timestamp_ms"].tolist() == [105000, 106000, 107000]
+    assert history.counts(recent) == {"Sad": 1, "Happy": 1, "Neutral": 1}
+    assert history.to_dataframe()["emotion"].tolist() == emotions[3:]
+
+
+def test_history_rejects_more_than_255_labels():
+    history = ed.EmotionHistory(capacity=4)
+    for i in range(255):
+        history.append("Happy", 50.0, camera=f"cam_{i}", timestamp=float(i))
+    with pytest.raises(ValueError):
+        history.append("Happy", 50.0, camera="cam_255", timestamp=255.0)
+    # ป้ายที่มีอยู่แล้วยังใช้ได้ และเรคอร์ดที่ล้มเหลวไม่ถูกเขียน
+    history.append("Happy", 50.0, camera="cam_0", timestamp=256.0)
+    assert history.records()["timestamp_ms"].tolist() == [252000, 253000, 254000, 256000]
+    assert len(history.camera_names) == 255
+
+
+def slow_probe(value, delay):
+    def probe():
+        time.sleep(delay)
+        return value
+    return probe
+
+
+def test_run_probes_prefers_slow_higher_priority_group(detector, monkeypatch):
+    released = []
+    monkeypatch.setattr(detector, "_release_camera_handle", released.append)
+    groups = [
+        [("broken", slow_probe(None, 0.1)), ("picamera2", slow_probe("A", 0.4))],
+        [("usb_0", slow_probe("B", 0.0))],
+    ]
+    assert detector._run_probes(groups, timeout=5.0) == ("picamera2", "A")
+    assert wait_for(lambda: released == ["B"], timeout=2.0)
+
+
+def test_run_probes_falls_back_after_priority_grace(detector, monkeypatch):
+    released = []
+    monkeypatch.setattr(detector, "_release_camera_handle", released.append)
+    monkeypatch.setattr(ed, "CAMERA_PRIORITY_GRACE", 0.2)
+    groups = [
+        [("picamera2", slow_probe("A", 1.0))],
+        [("usb_0", slow_probe("B", 0.0))],
+    ]
+    started = time.time()
+    assert detector._run_probes(groups, timeout=5.0) == ("usb_0", "B")
+    assert time.time() - started < 0.8
+    # กลุ่มที่เปิดได้หลังหมดเวลารอต้องถูกปิดทิ้ง
+    assert wait_for(lambda: released == ["A"], timeout=2.0)
+
+
+def test_pin_argument_parses_roles():
+    args = ed.parse_args(["--pin", "capture=0,inference=1-2+4,persistence=3"])
+    assert args.pin == {"capture": [0], "inference": [1, 2, 4], "persistence": [3]}
+
+
+@pytest.mark.parametrize("spec", ["foo=1", "capture=x", "capture=", "capture=3-1", "inference=-1"])
+def test_pin_argument_rejects_bad_spec(spec, capsys):
+    # ต้องเป็นข้อความ usage ของ argparse (exit 2) ไม่ใช่ ValueError traceback
+    with pytest.raises(SystemExit) as exc:
+        ed.parse_args(["--pin", spec])
+    assert exc.value.code == 2
+    assert "--pin" in capsys.readouterr().err
+
+
+def test_thread_budget_candidates_sweep_inter_op(monkeypatch):
+    monkeypatch.setattr(ed, "DEEPFACE_AVAILABLE", True)
+    candidates = ed.thread_budget_candidates(cores=4)
+    assert {budget.tf_inter for budget in candidates} == {1, 2}
+    settings = [(b.cv_threads, b.tf_intra, b.tf_inter, json.dumps(b.affinity)) for b in candidates]
+    assert len(settings) == len(set(settings))
+
+    monkeypatch.setattr(ed, "DEEPFACE_AVAILABLE", False)
+    assert {budget.tf_inter for budget in ed.thread_budget_candidates(cores=4)} == {None}